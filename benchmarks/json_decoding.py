@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""Compare the json, ujson and orjson decoders on webhook payloads, and reading bodies with the bounded body reader."""
+
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import importlib
+import io
+import json
+import os
+import sys
+import timeit
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from src.payload import JSON_BACKEND, read_body
+
+
+__author__ = 'Evan Williams'
+
+
+def make_payload(commits):
+    """A GitHub push payload with the given number of commits (each about 1 KB when serialized)."""
+    return {
+        'ref': 'refs/heads/main',
+        'compare': 'https://github.com/octocat/hello-world/compare/1a2b3c...4d5e6f',
+        'commits': [{
+            'id': '{0:040x}'.format(i),
+            'message': 'Commit number {0}\n\nWith a longer description of the change, including "quotes" and ünïcödé.'.format(i),
+            'timestamp': '2018-06-01T12:00:00-07:00',
+            'url': 'https://github.com/octocat/hello-world/commit/{0:040x}'.format(i),
+            'author': {'name': 'Monalisa Octocat', 'email': 'octocat@github.com', 'username': 'octocat'},
+            'committer': {'name': 'Monalisa Octocat', 'email': 'octocat@github.com', 'username': 'octocat'},
+            'added': ['src/file_{0}.py'.format(i)],
+            'removed': [],
+            'modified': ['README.md', 'src/module_{0}.py'.format(i)],
+            'distinct': True
+        } for i in range(commits)],
+        'pusher': {'name': 'octocat', 'email': 'octocat@github.com'},
+        'repository': {'id': 1296269, 'full_name': 'octocat/hello-world', 'html_url': 'https://github.com/octocat/hello-world', 'private': False},
+        'sender': {'login': 'octocat', 'id': 1, 'html_url': 'https://github.com/octocat', 'avatar_url': 'https://github.com/octocat.png'}
+    }
+
+
+def get_decoders():
+    """Get the ways of decoding a request body to compare, by name."""
+    decoders = [
+        ('json (str)', lambda data: json.loads(data.decode('utf-8'))),
+        ('json (bytes)', json.loads),
+    ]
+    for module_name in ('ujson', 'orjson'):
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            print('{0} is not installed, skipping it'.format(module_name))
+            continue
+        decoders.append(('{0} (bytes)'.format(module_name), module.loads))
+    return decoders
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark reading and decoding webhook event payloads with each installed JSON library.')
+    arg_parser.add_argument('-c', dest='commits', type=int, default=400, help='number of commits in the sample payload')
+    arg_parser.add_argument('-n', dest='number', type=int, default=50, help='number of iterations per measurement')
+    args = arg_parser.parse_args()
+
+    data = json.dumps(make_payload(args.commits)).encode('utf-8')
+    headers = {'Content-Length': str(len(data))}
+    chunked_data = b''.join(b'%x\r\n%s\r\n' % (len(data[i:i + 8192]), data[i:i + 8192]) for i in range(0, len(data), 8192)) + b'0\r\n\r\n'
+
+    print('payload of {0} commits ({1} KB), {2} iterations, server uses {3}'.format(args.commits, len(data) // 1024, args.number, JSON_BACKEND))
+    print('{0:<24}{1:>12}'.format('stage', 'time (ms)'))
+
+    read_time = timeit.timeit(lambda: read_body(io.BytesIO(data), headers), number=args.number) / args.number
+    print('{0:<24}{1:>12.3f}'.format('read (Content-Length)', read_time * 1000))
+    read_time = timeit.timeit(lambda: read_body(io.BytesIO(chunked_data), {'Transfer-Encoding': 'chunked'}), number=args.number) / args.number
+    print('{0:<24}{1:>12.3f}'.format('read (chunked)', read_time * 1000))
+
+    for name, decode in get_decoders():
+        decode_time = timeit.timeit(lambda: decode(data), number=args.number) / args.number
+        print('{0:<24}{1:>12.3f}'.format(name, decode_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
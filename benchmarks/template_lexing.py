@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Compare lexing single characters against runs of literal text when compiling and rendering templates."""
+
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import os
+import sys
+import timeit
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from src.lexer import WebhookHubLexer
+from src.parser import WebhookHubParser, WebhookHubParserContext
+from src.route import WebhookHubRoute
+
+
+__author__ = 'Evan Williams'
+
+
+SAMPLE_PAYLOAD = {
+    'ref': 'refs/heads/main',
+    'compare': 'https://github.com/octocat/hello-world/compare/1a2b3c...4d5e6f',
+    'deleted': False,
+    'forced': False,
+    'commits': [{'id': str(i), 'message': 'Commit number {0}'.format(i)} for i in range(20)],
+    'pusher': {'name': 'octocat'},
+    'repository': {'full_name': 'octocat/hello-world', 'html_url': 'https://github.com/octocat/hello-world'},
+    'sender': {'login': 'octocat', 'html_url': 'https://github.com/octocat', 'avatar_url': 'https://github.com/octocat.png'}
+}
+
+
+def count_tokens(text, text_runs):
+    lexer = WebhookHubLexer(text_runs=text_runs)
+    lexer.input(text)
+    return sum(1 for _ in iter(lexer.token, None))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark lexing and rendering of a WebhookHub template.')
+    arg_parser.add_argument('-t', dest='template', default=os.path.join(ROOT_DIR, 'templates', 'discord'), help='template file to benchmark')
+    arg_parser.add_argument('-c', dest='config', default=os.path.join(ROOT_DIR, 'config', 'github.ini'), help='route configuration to render with')
+    arg_parser.add_argument('-e', dest='event_key', default='push', help='event key of the configuration to render with')
+    arg_parser.add_argument('-n', dest='number', type=int, default=200, help='number of iterations per measurement')
+    args = arg_parser.parse_args()
+
+    with open(args.template, 'r') as fin:
+        text = fin.read()
+
+    event_config = WebhookHubRoute.from_file(args.config).get_event_configuration(args.event_key)
+
+    # Like the server, use a new context (and so new memoized config variables) for every render
+    def new_context():
+        return WebhookHubParserContext(payload=SAMPLE_PAYLOAD, event_config=event_config)
+
+    print('{0} ({1} characters), {2} iterations'.format(args.template, len(text), args.number))
+    print('{0:<20}{1:>10}{2:>16}{3:>16}'.format('lexer mode', 'tokens', 'compile (ms)', 'render (ms)'))
+
+    for label, text_runs in (('single characters', False), ('text runs', True)):
+        parser = WebhookHubParser(text_runs=text_runs)
+
+        compile_time = timeit.timeit(lambda: parser.compile(text), number=args.number) / args.number
+        render_time = timeit.timeit(lambda: parser.compile(text).render(new_context()), number=args.number) / args.number
+
+        print('{0:<20}{1:>10}{2:>16.3f}{3:>16.3f}'.format(label, count_tokens(text, text_runs), compile_time * 1000, render_time * 1000))
+
+    # Rendering a plan compiled ahead of time is what the server does for every webhook event
+    template = WebhookHubParser().compile(text)
+    render_time = timeit.timeit(lambda: template.render(new_context()), number=args.number) / args.number
+    print('{0:<20}{1:>10}{2:>16}{3:>16.3f}'.format('precompiled', '-', '-', render_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
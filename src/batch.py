@@ -0,0 +1,171 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import collections
+import email.message
+import json
+import os
+import requests
+
+from concurrent.futures import ProcessPoolExecutor
+
+from src.cache import WebhookHubCache
+from src.delivery import WebhookHubDeliveryClient
+from src.parser import WebhookHubParserContext
+from src.payload import decode_payload
+from src.reformat import RenderedPayload, render_payload
+from src.route import WebhookHubRouteError
+
+
+__author__ = 'Evan Williams'
+
+
+# Records sent to a worker process at once, amortizing the cost of each round trip between processes
+DEFAULT_CHUNK_SIZE = 64
+
+# Chunks in flight per worker process, bounding how far reading may get ahead of writing
+CHUNKS_PER_WORKER = 4
+
+# The routes and templates of each worker process (see init_worker)
+worker = None
+
+
+class WebhookHubBatchWorker:
+    """Renders archived webhook events in a worker process, with its own cache of routes and templates."""
+
+    def __init__(self, config_dir, templates_dir, deliver=False):
+        self.cache = WebhookHubCache(config_dir, templates_dir)
+        self.delivery_client = WebhookHubDeliveryClient() if deliver else None
+
+    def render_chunk(self, chunk):
+        """
+        Render a chunk of (line number, line) pairs, returning the result of each as a line of JSON and the number which failed.
+        A record which fails, for whatever reason, only fails its own result, so one bad record never stops a whole archive.
+        """
+        results = []
+        failed = 0
+        for number, line in chunk:
+            try:
+                result = dict({'line': number}, **self.render_record(decode_payload(line)))
+            except Exception as e:
+                result = {'line': number, 'error': str(e) or type(e).__name__}
+                failed += 1
+            results.append(json.dumps(result) + '\n')
+        return (results, failed)
+
+    def render_record(self, record):
+        """Render an archived webhook event, a dictionary of its "headers", "payload" and optionally its request "path"."""
+        if type(record) != dict or 'payload' not in record:
+            raise WebhookHubBatchError('record has no payload')
+        payload = record['payload']
+        path = record.get('path') or '/'
+        headers = email.message.Message()
+        for key, value in (record.get('headers') or {}).items():
+            headers[key] = value
+
+        route, event_key, _ = self.cache.snapshot.match_route(path, headers)
+        if route is None:
+            raise WebhookHubRouteError('No compatible route is defined for this User-Agent')
+        if not event_key:
+            event_key = route.get_event_key(headers, payload)
+        if not event_key:
+            raise WebhookHubRouteError('Unable to determine the event key for this webhook event')
+
+        event_config = route.get_event_configuration(event_key)
+        if not event_config:
+            raise WebhookHubRouteError('No compatible event configuration for this webhook event')
+
+        context = WebhookHubParserContext(payload=payload, event_config=event_config)
+        targets = []
+        for destination, template_name in route.get_targets(event_key):
+            destination = context.parse(destination)
+            reformatted_payload = render_payload(payload, self.cache.get_template(template_name), event_config, context=context)
+            target = {'destination': destination, 'template': template_name,
+                'payload': reformatted_payload.decode() if type(reformatted_payload) == RenderedPayload else reformatted_payload}
+            if self.delivery_client:
+                target.update(self.deliver(destination, reformatted_payload, route))
+            targets.append(target)
+
+        return {'route': route.agent, 'event': event_key, 'targets': targets}
+
+    def deliver(self, destination, payload, route):
+        try:
+            response = self.delivery_client.post(destination, payload, connect_timeout=route.connect_timeout, read_timeout=route.read_timeout)
+        except requests.exceptions.RequestException as e:
+            return {'error': str(e)}
+        return {'status': response.status_code}
+
+
+def init_worker(config_dir, templates_dir, deliver):
+    global worker
+    worker = WebhookHubBatchWorker(config_dir, templates_dir, deliver=deliver)
+
+
+def render_chunk(chunk):
+    return worker.render_chunk(chunk)
+
+
+def read_chunks(fin, chunk_size):
+    """Read (line number, line) pairs from a file of JSON lines in chunks, skipping blank lines."""
+    chunk = []
+    for number, line in enumerate(fin, 1):
+        if not line.strip():
+            continue
+        chunk.append((number, line))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def render_batch(fin, fout, config_dir, templates_dir, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, deliver=False):
+    """
+    Render every archived webhook event in a file of JSON lines (opened in binary mode) with a pool of worker processes,
+    writing the results to a file in the same order as they are rendered. Only a bounded window of chunks is in flight
+    at once, so files of any size are rendered in constant memory. Returns the number of records, and of those which failed.
+    """
+    workers = workers or os.cpu_count() or 1
+    records = failed = 0
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config_dir, templates_dir, deliver)) as executor:
+        futures = collections.deque()
+
+        def write_next():
+            nonlocal records, failed
+            results, chunk_failed = futures.popleft().result()
+            fout.writelines(results)
+            records += len(results)
+            failed += chunk_failed
+
+        for chunk in read_chunks(fin, chunk_size):
+            if len(futures) >= workers * CHUNKS_PER_WORKER:
+                write_next()
+            futures.append(executor.submit(render_chunk, chunk))
+        while futures:
+            write_next()
+
+    return (records, failed)
+
+
+class WebhookHubBatchError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
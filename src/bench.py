@@ -0,0 +1,239 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import email.message
+import io
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.parser import WebhookHubParserContext
+from src.payload import JSON_BACKEND, decode_payload, read_body
+from src.reformat import render_payload
+
+
+__author__ = 'Evan Williams'
+
+
+# Stages of handling a webhook event which are timed, in the order they happen
+BENCH_STAGES = ('decode', 'route', 'project', 'event key', 'render', 'deliver')
+
+PERCENTILES = (50, 99)
+
+
+class WebhookHubBenchSample:
+    """A recorded webhook event, as the headers and body of the request its origin sent."""
+
+    def __init__(self, name, headers, body, path='/'):
+        self.name = name
+        self.headers = email.message.Message()
+        for key, value in headers.items():
+            self.headers[key] = value
+        self.body = body
+        self.path = path
+
+    def __str__(self):
+        return 'WebhookHubBenchSample({0}, {1} bytes)'.format(self.name, len(self.body))
+
+    @staticmethod
+    def from_file(path):
+        """Load a sample from a JSON file holding its "headers", "payload" and optionally its request "path"."""
+        with open(path, 'r') as fin:
+            sample = json.load(fin)
+        body = json.dumps(sample['payload']).encode('utf-8')
+        headers = dict(sample.get('headers', {}), **{'Content-Length': str(len(body))})
+        return WebhookHubBenchSample(os.path.splitext(os.path.basename(path))[0], headers, body, path=sample.get('path', '/'))
+
+
+def load_corpus(corpus_dir):
+    """Load the samples from every .json file in a directory, in a fixed order."""
+    return [WebhookHubBenchSample.from_file(os.path.join(corpus_dir, file)) for file in sorted(os.listdir(corpus_dir)) if file.endswith('.json')]
+
+
+class WebhookHubStubDestination:
+    """A local destination accepting every webhook event delivered to it with 204 No Content, like Discord does."""
+
+    def __init__(self):
+        class StubRequestHandler(BaseHTTPRequestHandler):
+            # Keep connections alive, as real destinations do
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        # Each keep-alive connection is served by its own (daemon) thread, which doesn't hold up stop()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubRequestHandler)
+        self.url = 'http://127.0.0.1:{0}/webhook'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='webhookhub-bench-stub', daemon=True)
+
+    def __str__(self):
+        return 'WebhookHubStubDestination({0})'.format(self.url)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class WebhookHubBenchmark:
+    """
+    Replays samples through the same steps the request handler takes, timing each stage of every event.
+    Every delivery goes to the given (stub) destination, whatever the route's destination evaluates to.
+    """
+
+    def __init__(self, cache, delivery_client, destination, project_payloads=False):
+        self.cache = cache
+        self.delivery_client = delivery_client
+        self.destination = destination
+        self.project_payloads = project_payloads
+
+        self.timings = {stage: [] for stage in BENCH_STAGES}
+        self.events = 0
+        self.errors = {}
+        self.elapsed = 0.0
+
+    def run(self, samples, iterations, warmup=1):
+        """Replay every sample the given number of times, after unmeasured warmup rounds (compiling templates, etc.)."""
+        for _ in range(warmup):
+            for sample in samples:
+                self.replay(sample, {stage: [] for stage in BENCH_STAGES})
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for sample in samples:
+                if self.replay(sample, self.timings):
+                    self.events += 1
+        self.elapsed += time.perf_counter() - start
+
+    def replay(self, sample, timings):
+        """Replay a sample, returning whether it was delivered (failures are counted rather than raised)."""
+        try:
+            self.handle(sample, timings)
+        except Exception as e:
+            error = '{0}: {1}'.format(type(e).__name__, e)
+            if error not in self.errors.setdefault(sample.name, {}):
+                sys.stderr.write('Failed to replay sample "{0}": {1}\n'.format(sample.name, error))
+            self.errors[sample.name][error] = self.errors[sample.name].get(error, 0) + 1
+            return False
+        return True
+
+    def handle(self, sample, timings):
+        clock = time.perf_counter
+
+        start = clock()
+        payload = decode_payload(read_body(io.BytesIO(sample.body), sample.headers))
+        timings['decode'].append(clock() - start)
+
+        start = clock()
+        snapshot = self.cache.snapshot
+        route, event_key, _ = snapshot.match_route(sample.path, sample.headers)
+        timings['route'].append(clock() - start)
+        if route is None:
+            raise ValueError('no route matches the sample')
+
+        if self.project_payloads:
+            start = clock()
+            projection = self.cache.get_projection(snapshot, route)
+            if projection is not None:
+                payload = projection.project(payload)
+            timings['project'].append(clock() - start)
+
+        start = clock()
+        if not event_key:
+            event_key = route.get_event_key(sample.headers, payload)
+        event_config = route.get_event_configuration(event_key) if event_key else None
+        timings['event key'].append(clock() - start)
+        if not event_config:
+            raise ValueError('no event configuration for event key "{0}"'.format(event_key))
+
+        for destination, template_name in route.get_targets(event_key):
+            start = clock()
+            context = WebhookHubParserContext(payload=payload, event_config=event_config)
+            context.parse(destination)
+            reformatted_payload = render_payload(payload, self.cache.get_template(template_name), event_config, context=context)
+            timings['render'].append(clock() - start)
+
+            start = clock()
+            response = self.delivery_client.post(self.destination, reformatted_payload, connect_timeout=route.connect_timeout, read_timeout=route.read_timeout)
+            timings['deliver'].append(clock() - start)
+            if response.status_code >= 300:
+                raise ValueError('destination responded with {0}'.format(response.status_code))
+
+    def results(self):
+        """Get the results as a dictionary which can be serialized as JSON, and compared between versions."""
+        stages = {}
+        for stage in BENCH_STAGES:
+            values = sorted(self.timings[stage])
+            total = sum(values)
+            stages[stage] = dict({
+                'count': len(values),
+                'mean_ms': total / len(values) * 1000 if values else None,
+                'per_sec': len(values) / total if total else None,
+            }, **{'p{0}_ms'.format(p): percentile(values, p) * 1000 if values else None for p in PERCENTILES})
+
+        return {
+            'python': sys.version.split()[0],
+            'json_backend': JSON_BACKEND,
+            'events': self.events,
+            'elapsed_sec': self.elapsed,
+            'events_per_sec': self.events / self.elapsed if self.elapsed else None,
+            'routes_per_sec': stages['route']['per_sec'],
+            'renders_per_sec': stages['render']['per_sec'],
+            'stages': stages,
+            'errors': {name: sum(errors.values()) for name, errors in self.errors.items()},
+        }
+
+
+def percentile(sorted_values, p):
+    """Get the p-th percentile of a non-empty sorted list, using the nearest-rank method."""
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def format_results(results):
+    """Format benchmark results as a table, for people rather than machines."""
+    lines = [
+        '{0} events in {1:.2f} s ({2:.1f} events/s, {3:.1f} routes/s, {4:.1f} renders/s), Python {5}, decoding with {6}'.format(
+            results['events'], results['elapsed_sec'], results['events_per_sec'] or 0, results['routes_per_sec'] or 0,
+            results['renders_per_sec'] or 0, results['python'], results['json_backend']),
+        '{0:<12}{1:>10}{2:>12}{3:>12}{4:>12}'.format('stage', 'count', 'mean (ms)', 'p50 (ms)', 'p99 (ms)'),
+    ]
+    for stage in BENCH_STAGES:
+        timing = results['stages'][stage]
+        if timing['count']:
+            lines.append('{0:<12}{1:>10}{2:>12.3f}{3:>12.3f}{4:>12.3f}'.format(stage, timing['count'], timing['mean_ms'], timing['p50_ms'], timing['p99_ms']))
+        else:
+            lines.append('{0:<12}{1:>10}'.format(stage, 0))
+    for name, count in sorted(results['errors'].items()):
+        lines.append('{0} failed {1} times'.format(name, count))
+    return '\n'.join(lines)
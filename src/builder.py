@@ -0,0 +1,268 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import re
+
+from collections import namedtuple
+
+from src.parser import compile_template, WebhookHubParserError
+from src.template import TextNode, SymbolNode
+
+
+__author__ = 'Evan Williams'
+
+
+# File extension of structured templates (see compile_object_template)
+OBJECT_TEMPLATE_SUFFIX = '.json'
+
+CONDITION_PATTERN = re.compile(r'^\s*(not\s+)?\$?((?:data|config|env|key)(?:\.[\w\-]+)*)\s*$')
+LOOP_PATTERN = re.compile(r'^\s*(\w)\s+in\s+\$?((?:data|config|env|key)(?:\.[\w\-]+)*)\s*$')
+
+# Returned by an $if without a matching branch, whose key (in an object) or item (in a list) is then left out
+OMITTED = object()
+
+
+class WebhookHubObjectTemplate:
+    """
+    A template written as JSON, whose strings may contain injections, compiled into builders which produce the
+    reformatted payload as Python objects directly, without rendering and parsing any intermediate JSON text.
+
+    A string which is a single symbol (e.g. "$data.commits.length") is replaced by the symbol's value with its own
+    type, while any other string is rendered as text. Objects with these keys are evaluated instead:
+    - {"$if": "<symbol>", "$then": ..., "$else": ...}: $then if the symbol (optionally "not <symbol>") is truthy,
+      otherwise $else, or if there is none, the object's key or the list's item is left out
+    - {"$for": "<key> in <symbol>", "$each": ...}: a list of $each for every key of the symbol's list or dictionary,
+      spliced into the enclosing list if there is one
+    - {"$int": ...}, {"$float": ...}, {"$bool": ...}, {"$str": ...}: a value converted to the given type
+    """
+
+    __slots__ = ('source', 'builder')
+
+    def __init__(self, source, builder):
+        self.source = source
+        self.builder = builder
+
+    def __str__(self):
+        return 'WebhookHubObjectTemplate({0})'.format(type(self.builder).__name__)
+
+    def build(self, context):
+        """Build the payload of this template, evaluating symbols with the given context (e.g. a WebhookHubParserContext)."""
+        value = self.builder.build(WebhookHubBuildContext(context), {})
+        return None if value is OMITTED else value
+
+
+class WebhookHubBuildContext:
+    """
+    Wraps a WebhookHubParserContext for building objects, where text is rendered without the escaping
+    that is needed to inject it into JSON text.
+    """
+
+    __slots__ = ('context',)
+
+    def __init__(self, context):
+        self.context = context
+
+    def evaluate_symbol(self, symbol, index_context={}, stringify=False):
+        value = self.context.evaluate_symbol(symbol, index_context=index_context)
+        if symbol.split('.')[0] == 'config':
+            # Config values are rendered as JSON text, so undo the escaping of any data they contain
+            value = unescape_json_string(value)
+        if not stringify:
+            return value
+
+        if value is None:
+            return ''
+        elif type(value) in [bool, int, float, dict, list]:
+            return json.dumps(value) if type(value) not in [dict, list] else str(value)
+        return str(value)
+
+    def get_indexes(self, symbol, index_context={}):
+        return self.context.get_indexes(symbol, index_context=index_context)
+
+
+# Builders. Every builder is an immutable tuple exposing build(context, index_context), like template nodes.
+
+class ConstantBuilder(namedtuple('ConstantBuilder', ['value'])):
+    __slots__ = ()
+
+    def build(self, context, index_context):
+        return self.value
+
+
+class SymbolBuilder(namedtuple('SymbolBuilder', ['symbol'])):
+    __slots__ = ()
+
+    def build(self, context, index_context):
+        return context.evaluate_symbol(self.symbol, index_context=index_context)
+
+
+class TextBuilder(namedtuple('TextBuilder', ['template'])):
+    __slots__ = ()
+
+    def build(self, context, index_context):
+        return ''.join([node.render(context, index_context) for node in self.template.nodes])
+
+
+class ObjectBuilder(namedtuple('ObjectBuilder', ['items'])):
+    __slots__ = ()
+
+    def build(self, context, index_context):
+        built = {}
+        for key, value in self.items:
+            value = value.build(context, index_context)
+            if value is not OMITTED:
+                built[key.build(context, index_context)] = value
+        return built
+
+
+class ListBuilder(namedtuple('ListBuilder', ['items'])):
+    __slots__ = ()
+
+    def build(self, context, index_context):
+        built = []
+        for item in self.items:
+            value = item.build(context, index_context)
+            if value is OMITTED:
+                continue
+            elif type(item) == ForBuilder:
+                built.extend(value)
+            else:
+                built.append(value)
+        return built
+
+
+class IfBuilder(namedtuple('IfBuilder', ['symbol', 'negate', 'then', 'orelse'])):
+    __slots__ = ()
+
+    def build(self, context, index_context):
+        condition = bool(context.evaluate_symbol(self.symbol, index_context=index_context))
+        branch = self.then if condition != self.negate else self.orelse
+        return branch.build(context, index_context) if branch is not None else OMITTED
+
+
+class ForBuilder(namedtuple('ForBuilder', ['index_symbol', 'symbol', 'each'])):
+    __slots__ = ()
+
+    def build(self, context, index_context):
+        indexes = context.get_indexes(self.symbol, index_context=index_context)
+
+        built = []
+        try:
+            for index in indexes:
+                index_context[self.index_symbol] = index
+                value = self.each.build(context, index_context)
+                if value is not OMITTED:
+                    built.append(value)
+        finally:
+            index_context.pop(self.index_symbol, None)
+        return built
+
+
+class ConvertBuilder(namedtuple('ConvertBuilder', ['type_name', 'value'])):
+    __slots__ = ()
+
+    def build(self, context, index_context):
+        value = self.value.build(context, index_context)
+        if value is OMITTED:
+            return value
+
+        try:
+            if self.type_name == '$int':
+                return int(value) if type(value) != str else int(float(value))
+            elif self.type_name == '$float':
+                return float(value)
+            elif self.type_name == '$bool':
+                return value.strip().lower() in ['true', 'yes', '1'] if type(value) == str else bool(value)
+            return value if type(value) == str else ('' if value is None else json.dumps(value))
+        except (TypeError, ValueError):
+            raise WebhookHubParserError('cannot convert "{0}" with {1}'.format(value, self.type_name))
+
+
+CONVERSIONS = ('$int', '$float', '$bool', '$str')
+
+
+def compile_object_template(text):
+    """
+    Compile the text of a structured (JSON) template into a WebhookHubObjectTemplate.
+    Raises ValueError if the text is not JSON, and SyntaxError if any of its strings or constructs are invalid.
+
+    >>> template = compile_object_template('{"count": "$data.a.length", "text": "$data.a.length commits"}')
+    >>> template.build(WebhookHubParserContext(payload={'a': [1, 2]}))
+    {'count': 2, 'text': '2 commits'}
+    """
+    return WebhookHubObjectTemplate(text, compile_builder(json.loads(text), ()))
+
+
+def compile_builder(value, index_symbols):
+    if type(value) == str:
+        return compile_string_builder(value)
+    elif type(value) == list:
+        return ListBuilder(tuple(compile_builder(item, index_symbols) for item in value))
+    elif type(value) != dict:
+        return ConstantBuilder(value)
+
+    if '$if' in value:
+        match = CONDITION_PATTERN.match(str(value['$if']))
+        if not match or set(value) - {'$if', '$then', '$else'}:
+            raise SyntaxError('Invalid $if "{0}", expected {{"$if": "<symbol>", "$then": ..., "$else": ...}}'.format(value['$if']))
+        then = compile_builder(value['$then'], index_symbols) if '$then' in value else None
+        orelse = compile_builder(value['$else'], index_symbols) if '$else' in value else None
+        return IfBuilder(match.group(2), bool(match.group(1)), then, orelse)
+
+    if '$for' in value:
+        match = LOOP_PATTERN.match(str(value['$for']))
+        if not match or set(value) != {'$for', '$each'}:
+            raise SyntaxError('Invalid $for "{0}", expected {{"$for": "<key> in <symbol>", "$each": ...}}'.format(value['$for']))
+        if match.group(1) in index_symbols:
+            raise SyntaxError('Nested $for reuses the key "{0}" of an enclosing $for'.format(match.group(1)))
+        return ForBuilder(match.group(1), match.group(2), compile_builder(value['$each'], index_symbols + (match.group(1),)))
+
+    conversions = [key for key in value if key in CONVERSIONS]
+    if conversions:
+        if len(value) != 1:
+            raise SyntaxError('Invalid {0}, expected an object with no other keys'.format(conversions[0]))
+        return ConvertBuilder(conversions[0], compile_builder(value[conversions[0]], index_symbols))
+
+    return ObjectBuilder(tuple((compile_string_builder(key), compile_builder(item, index_symbols)) for key, item in value.items()))
+
+
+def compile_string_builder(text):
+    # Strings without any injection or escaped character are constant
+    if '$' not in text and '\\' not in text:
+        return ConstantBuilder(text)
+
+    template = compile_template(text)
+    if not template.nodes:
+        return ConstantBuilder('')
+    elif len(template.nodes) == 1 and type(template.nodes[0]) == TextNode:
+        return ConstantBuilder(template.nodes[0].text)
+    elif len(template.nodes) == 1 and type(template.nodes[0]) == SymbolNode:
+        return SymbolBuilder(template.nodes[0].symbol)
+    return TextBuilder(template)
+
+
+def unescape_json_string(value):
+    if type(value) != str or '\\' not in value:
+        return value
+    try:
+        return json.loads('"{0}"'.format(value), strict=False)
+    except ValueError:
+        return value
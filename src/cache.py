@@ -0,0 +1,220 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import threading
+import time
+
+from src.builder import OBJECT_TEMPLATE_SUFFIX, compile_object_template
+from src.matcher import WebhookHubRouteMatcher
+from src.parser import compile_template, WebhookHubParserError
+from src.projection import WebhookHubPayloadProjection, collect_data_paths
+from src.router import WebhookHubPathRouter
+from src.route import WebhookHubRoute, WebhookHubRouteError
+
+
+__author__ = 'Evan Williams'
+
+
+class WebhookHubRouteSnapshot:
+    """
+    The routes loaded from a directory of .ini files at some point, with the matcher and router built from them and the
+    payload projections computed for them. A snapshot is never changed once published (projections are only added),
+    so handling a request with one snapshot never mixes old and new routes, whatever is reloaded meanwhile.
+    """
+
+    __slots__ = ('routes', 'matcher', 'router', 'projections')
+
+    def __init__(self, routes, matcher=None, router=None):
+        self.routes = routes
+        self.matcher = matcher or WebhookHubRouteMatcher(routes.values())
+        self.router = router or WebhookHubPathRouter(routes.values())
+        # Payload projections by route, computed on first use (see WebhookHubCache.get_projection)
+        self.projections = {}
+
+    def __str__(self):
+        return 'WebhookHubRouteSnapshot({0} routes)'.format(len(self.routes))
+
+    def without_projections(self):
+        """Get a snapshot of the same routes whose projections are computed again, e.g. because templates changed."""
+        return WebhookHubRouteSnapshot(self.routes, matcher=self.matcher, router=self.router)
+
+    def match_route(self, path, headers):
+        """
+        Get the route of a webhook event and the event key given by its path (or None), or (None, None, None) if it has
+        no route. Events are routed by their request path (see WebhookHubPathRouter), falling back to their headers,
+        and events without a key in their path get it from their route (see WebhookHubRoute.get_event_key).
+        Also returns the route path (and configured event key) of an event routed by its path, e.g. /hooks/github/push.
+        """
+        route, event_key = self.router.match(path)
+        routed_path = None
+        if route is not None:
+            routed_path = route.path.rstrip('/')
+            if event_key in route.configurations:
+                routed_path = '{0}/{1}'.format(routed_path, event_key)
+        else:
+            route = self.matcher.match(path, headers)
+            if route is None:
+                return (None, None, None)
+        return (route, event_key, routed_path)
+
+
+class WebhookHubCache:
+    """
+    An in-memory cache of the routes loaded from a directory of .ini files and of the templates compiled from a
+    directory of template files. Requests never touch the filesystem: changed files are picked up by refresh(),
+    called periodically by watch() or on demand (e.g. on SIGHUP), which publishes a new WebhookHubRouteSnapshot
+    with a single assignment. Requests take one reference to the current snapshot and use it throughout.
+    """
+
+    def __init__(self, config_dir, templates_dir):
+        self.config_dir = config_dir
+        self.templates_dir = templates_dir
+
+        # Reentrant, since refresh() may also be called from a signal handler
+        self.lock = threading.RLock()
+        self.watcher = None
+        self.watcher_pid = None
+
+        # Templates by name, as (file signature, compiled template)
+        self.templates = {}
+
+        self.config_signature = self.get_config_signature()
+        self.snapshot = WebhookHubRouteSnapshot(self.load_routes())
+
+    def __str__(self):
+        return 'WebhookHubCache({0} routes, {1} templates)'.format(len(self.snapshot.routes), len(self.templates))
+
+    def get_template(self, name):
+        """
+        Get a compiled template by name, loading and compiling it on first use.
+        Templates named *.json are structured templates (see WebhookHubObjectTemplate).
+        """
+        cached = self.templates.get(name)
+        if cached is not None:
+            return cached[1]
+
+        path = os.path.join(self.templates_dir, name)
+        try:
+            signature = get_file_signature(path)
+            with open(path, 'r') as fin:
+                text = fin.read()
+        except OSError:
+            raise WebhookHubRouteError('template "{0}" does not exist'.format(name))
+
+        try:
+            if name.endswith(OBJECT_TEMPLATE_SUFFIX):
+                template = compile_object_template(text)
+            else:
+                template = compile_template(text)
+        except (SyntaxError, ValueError, WebhookHubParserError) as e:
+            raise WebhookHubRouteError('template "{0}" is invalid: {1}'.format(name, e))
+
+        self.templates[name] = (signature, template)
+        return template
+
+    def get_projection(self, snapshot, route):
+        """
+        Get the projection of payloads onto the data a route of a snapshot refers to (see WebhookHubPayloadProjection),
+        or None if the data it refers to can't be determined, e.g. because one of its templates is missing.
+        """
+        if route in snapshot.projections:
+            return snapshot.projections[route]
+
+        texts = [route.key_from_payload]
+        templates = set()
+        for targets in [route.get_targets(None)] + [configuration.targets for configuration in route.configurations.values()]:
+            for destination, _ in targets:
+                texts.append(destination)
+            templates.update(template for _, template in targets)
+        for configuration in route.configurations.values():
+            texts.extend(configuration.variables.values())
+
+        try:
+            projection = WebhookHubPayloadProjection(collect_data_paths(texts=texts, templates=[self.get_template(name) for name in sorted(templates)]))
+        except (WebhookHubRouteError, SyntaxError, WebhookHubParserError) as e:
+            sys.stderr.write('Unable to determine the data referred to by route "{0}": {1}\n'.format(route.agent, e))
+            projection = None
+
+        snapshot.projections[route] = projection
+        return projection
+
+    def load_routes(self):
+        # Files are loaded in a fixed order, which breaks ties between routes of the same priority
+        config_files = sorted(os.path.join(self.config_dir, file) for file in os.listdir(self.config_dir) if file.endswith('.ini'))
+        return {route.agent: route for route in [WebhookHubRoute.from_file(file) for file in config_files]}
+
+    def get_config_signature(self):
+        return {file: get_file_signature(os.path.join(self.config_dir, file)) for file in os.listdir(self.config_dir) if file.endswith('.ini')}
+
+    def refresh(self, force=False):
+        """Reload any routes and templates whose files have changed (or all of them if forced), returning whether any did."""
+        with self.lock:
+            changed = False
+            snapshot = self.snapshot
+
+            for name, (signature, _) in list(self.templates.items()):
+                if force or get_file_signature(os.path.join(self.templates_dir, name)) != signature:
+                    del self.templates[name]
+                    changed = True
+
+            if changed:
+                snapshot = snapshot.without_projections()
+
+            config_signature = self.get_config_signature()
+            if force or config_signature != self.config_signature:
+                try:
+                    snapshot = WebhookHubRouteSnapshot(self.load_routes())
+                except Exception as e:
+                    # Keep serving the previous routes until the configuration is fixed
+                    sys.stderr.write('Failed to reload routes from {0}: {1}\n'.format(self.config_dir, e))
+                else:
+                    self.config_signature = config_signature
+                    changed = True
+
+            self.snapshot = snapshot
+            return changed
+
+    def watch(self, interval):
+        """Refresh this cache every interval seconds on a background thread (one per process)."""
+        if self.watcher_pid == os.getpid():
+            return
+        self.watcher_pid = os.getpid()
+        self.watcher = threading.Thread(target=self.poll, args=(interval,), name='webhookhub-watcher', daemon=True)
+        self.watcher.start()
+
+    def poll(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                if self.refresh():
+                    sys.stderr.write('Reloaded changed configuration, now serving {0}\n'.format(self))
+            except OSError as e:
+                sys.stderr.write('Failed to check configuration for changes: {0}\n'.format(e))
+
+
+def get_file_signature(path):
+    """Get a signature of a file's contents, or None if it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
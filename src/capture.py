@@ -0,0 +1,243 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import base64
+import gzip
+import heapq
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+
+__author__ = 'Evan Williams'
+
+
+CAPTURE_PREFIX = 'capture-'
+CAPTURE_SUFFIX = '.jsonl.gz'
+
+# Uncompressed bytes written to a capture file before starting the next one, and capture files kept per process
+DEFAULT_CAPTURE_FILE_SIZE = 64 * 1024 * 1024
+DEFAULT_CAPTURE_FILES = 10
+
+# Captured requests which may wait to be written before new ones are dropped, so a slow disk never holds up requests
+DEFAULT_MAX_PENDING = 10000
+
+
+class WebhookHubCaptureLog:
+    """
+    Records every inbound request (its headers, raw body and timing) in a directory of gzipped files of JSON lines,
+    written by a background thread so that requests never wait on compression or the disk.
+
+    Each process writes its own numbered files, named by the time they were started and the process ID, starting a new file
+    after max_file_size (uncompressed) bytes and removing its oldest files beyond max_files. The writer thread is
+    started on first use in each process, so a capture log can be created before worker processes fork.
+
+    Records are {"time": ..., "duration_ms": ..., "status": ..., "method": ..., "path": ..., "headers": [[name, value], ...],
+    "body": base64 of the raw body, or null if it couldn't be read}.
+    """
+
+    def __init__(self, directory, max_file_size=DEFAULT_CAPTURE_FILE_SIZE, max_files=DEFAULT_CAPTURE_FILES, max_pending=DEFAULT_MAX_PENDING):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+        self.max_pending = max_pending
+
+        self.queue = None
+        self.writer = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+        # Files written by this process, oldest first, and the size written to the newest
+        self.files = []
+        self.file = None
+        self.file_size = 0
+        self.file_number = 0
+
+    def __str__(self):
+        return 'WebhookHubCaptureLog({0}, max_file_size={1}, max_files={2})'.format(self.directory, self.max_file_size, self.max_files)
+
+    def start(self):
+        """Start the writer thread of this capture log, unless it is already running in this process."""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.max_pending)
+            self.files = []
+            self.file = None
+            self.file_size = 0
+            self.file_number = 0
+            self.writer = threading.Thread(target=self.write, name='webhookhub-capture', daemon=True)
+            self.writer.start()
+
+    def record(self, arrival, duration, status, method, path, headers, body):
+        """Capture a request, given as it was received; it is serialized and written by the writer thread."""
+        self.start()
+        try:
+            self.queue.put_nowait((arrival, duration, status, method, path, headers, body))
+        except queue.Full:
+            self.dropped += 1
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                for item in items:
+                    self.write_record(to_record(*item) if item is not None else None)
+                # Flush once nothing is waiting, so captured requests are readable soon after they are handled
+                if self.file is not None:
+                    self.file.flush()
+            except OSError as e:
+                sys.stderr.write('Failed to write captured requests to {0}: {1}\n'.format(self.directory, e))
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+            if self.dropped:
+                with self.lock:
+                    dropped, self.dropped = self.dropped, 0
+                sys.stderr.write('Dropped {0} captured requests waiting to be written\n'.format(dropped))
+
+    def write_record(self, record):
+        if record is None:
+            # Close the current file (see close())
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            return
+
+        if self.file is None or self.file_size >= self.max_file_size:
+            self.rotate()
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        self.file.write(line)
+        self.file_size += len(line)
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+
+        self.file_number += 1
+        name = '{0}{1}-{2}-{3:06d}{4}'.format(CAPTURE_PREFIX, time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid(), self.file_number, CAPTURE_SUFFIX)
+        path = os.path.join(self.directory, name)
+
+        self.file = gzip.open(path, 'wb')
+        self.file_size = 0
+        self.files.append(path)
+
+        while len(self.files) > self.max_files:
+            try:
+                os.remove(self.files.pop(0))
+            except OSError as e:
+                sys.stderr.write('Failed to remove old capture file: {0}\n'.format(e))
+
+    def close(self, timeout=None):
+        """Wait for every captured request to be written, or until the timeout (in seconds) passes, and close the current file."""
+        if self.queue is None or self.pid != os.getpid():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                sys.stderr.write('Gave up waiting for {0} captured requests to be written\n'.format(self.queue.unfinished_tasks))
+                break
+            time.sleep(0.05)
+
+
+def to_record(arrival, duration, status, method, path, headers, body):
+    return {
+        'time': arrival,
+        'duration_ms': duration * 1000,
+        'status': status,
+        'method': method,
+        'path': path,
+        'headers': headers,
+        'body': base64.b64encode(body).decode('ascii') if body is not None else None,
+    }
+
+
+def find_capture_files(paths):
+    """Get the capture files among some paths, including those in any directories."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.startswith(CAPTURE_PREFIX) and name.endswith(CAPTURE_SUFFIX))
+        else:
+            files.append(path)
+    return files
+
+
+def read_capture_file(path):
+    """Read the records of a capture file, stopping at its end or at a record cut short (e.g. by a crash)."""
+    with gzip.open(path, 'rb') as fin:
+        try:
+            for line in fin:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    sys.stderr.write('Skipping truncated record in {0}\n'.format(path))
+                    return
+                if record.get('body') is not None:
+                    record['body'] = base64.b64decode(record['body'])
+                yield record
+        except (EOFError, OSError) as e:
+            sys.stderr.write('Capture file {0} ends early: {1}\n'.format(path, e))
+
+
+def read_capture(paths):
+    """
+    Read the records of every capture file among some paths in the order the requests arrived. The files of each
+    process are in order already, so they are merged as they are read, and captures of any size are read in constant memory.
+    """
+    files = find_capture_files(paths)
+    # Files of the same process are read one after another, and those of different processes are merged
+    by_process = {}
+    for path in sorted(files, key=os.path.basename):
+        by_process.setdefault(capture_file_process(path), []).append(path)
+    streams = [chain_capture_files(process_files) for _, process_files in sorted(by_process.items())]
+    return heapq.merge(*streams, key=lambda record: record['time'])
+
+
+def chain_capture_files(files):
+    for path in files:
+        yield from read_capture_file(path)
+
+
+def capture_file_process(path):
+    """Get the process ID a capture file was written by, from its name (capture-<time>-<pid>-<number>.jsonl.gz)."""
+    name = os.path.basename(path)
+    parts = name[len(CAPTURE_PREFIX):-len(CAPTURE_SUFFIX)].split('-')
+    if not (name.startswith(CAPTURE_PREFIX) and name.endswith(CAPTURE_SUFFIX)) or len(parts) != 3:
+        return name
+    return parts[1]
@@ -0,0 +1,437 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import heapq
+import itertools
+import os
+import queue
+import random
+import requests
+import sys
+import threading
+import time
+import uuid
+
+from collections import namedtuple
+from requests.adapters import HTTPAdapter
+
+from src.ratelimit import parse_retry_after
+from src.reformat import RenderedPayload
+
+
+__author__ = 'Evan Williams'
+
+
+# Maximum number of keep-alive connections kept open to each destination host
+DEFAULT_POOL_SIZE = 10
+
+# Maximum number of destination hosts to keep connection pools for
+DEFAULT_POOL_HOSTS = 32
+
+# Seconds to wait for a connection to a destination, and then for its response
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+
+# Number of threads delivering queued webhook events, and how many events may wait in the queue
+DEFAULT_DELIVERY_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 1000
+
+# Number of threads delivering webhook events to the targets of events that have more than one
+DEFAULT_FANOUT_WORKERS = 8
+
+# Number of times a queued webhook event is attempted, and the seconds to back off before its retries
+DEFAULT_MAX_ATTEMPTS = 5
+BASE_RETRY_BACKOFF = 1.0
+MAX_RETRY_BACKOFF = 300.0
+
+# List in payloads which is concatenated when merging deliveries to a rate limited destination (see merge_payloads)
+MERGE_KEY = 'embeds'
+
+# Maximum length of a merged list (Discord rejects messages with more than 10 embeds)
+MAX_MERGED_EMBEDS = 10
+
+# Headers describing a single connection, which must not be relayed from a destination to the origin
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+    'transfer-encoding', 'upgrade', 'content-encoding', 'content-length'}
+
+
+class WebhookHubDeliveryClient:
+    """
+    Delivers reformatted payloads to their destinations, reusing keep-alive connections from a pool per destination host.
+    A single client is shared by every route and request handler thread.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        adapter = HTTPAdapter(pool_connections=DEFAULT_POOL_HOSTS, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __str__(self):
+        return 'WebhookHubDeliveryClient(pool_size={0}, connect_timeout={1}, read_timeout={2})'.format(self.pool_size, self.connect_timeout, self.read_timeout)
+
+    def post(self, destination, payload, connect_timeout=None, read_timeout=None):
+        """
+        POST a JSON payload to a destination, overriding the client's timeouts if any are given.
+        A RenderedPayload is already JSON, so it is sent as is rather than serialized.
+        """
+        timeout = (connect_timeout or self.connect_timeout, read_timeout or self.read_timeout)
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        if type(payload) == RenderedPayload:
+            return self.session.post(destination, data=payload.encode('utf-8'), headers=headers, timeout=timeout)
+        return self.session.post(destination, json=payload, headers=headers, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+def relayed_headers(response):
+    """Get the headers of a destination's response which can be relayed to the origin."""
+    return [(key, value) for key, value in response.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS]
+
+
+class WebhookHubDelivery(namedtuple('WebhookHubDelivery', ['destination', 'payload', 'connect_timeout', 'read_timeout', 'id', 'attempt'], defaults=(None, 0))):
+    """A reformatted payload waiting to be delivered to its destination."""
+    __slots__ = ()
+
+    def to_record(self, due=0):
+        return {'op': 'put', 'id': self.id, 'attempt': self.attempt, 'due': due, 'destination': self.destination,
+            'payload': self.payload, 'rendered': type(self.payload) == RenderedPayload, 'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout}
+
+    @staticmethod
+    def from_record(record):
+        payload = RenderedPayload(record['payload']) if record.get('rendered') else record['payload']
+        return WebhookHubDelivery(record['destination'], payload, record['connect_timeout'], record['read_timeout'],
+            id=record['id'], attempt=record['attempt'])
+
+
+class WebhookHubDeliveryQueue:
+    """
+    An in-process queue of deliveries, drained by a pool of worker threads posting them with a WebhookHubDeliveryClient.
+    The worker threads are started on first use in each process, so a queue can be created before worker processes fork.
+
+    Deliveries which fail, or are answered with 429 or 5xx, are retried with exponential backoff (or after the
+    destination's Retry-After), up to max_attempts times. With a WebhookHubJournal, queued deliveries and their
+    retries survive restarts.
+
+    With a WebhookHubRateLimiter, deliveries to a saturated destination are held until it has capacity again,
+    and up to max_coalesce held Discord-style payloads (see merge_payloads) are then merged into one delivery.
+    """
+
+    def __init__(self, delivery_client, workers=DEFAULT_DELIVERY_WORKERS, max_size=DEFAULT_QUEUE_SIZE, max_attempts=DEFAULT_MAX_ATTEMPTS,
+            journal=None, rate_limiter=None, max_coalesce=1, debug=False):
+        self.delivery_client = delivery_client
+        self.workers = workers
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.journal = journal
+        self.rate_limiter = rate_limiter
+        self.max_coalesce = max_coalesce
+        self.debug = debug
+
+        self.queue = None
+        self.threads = []
+        self.pid = None
+        self.lock = threading.Lock()
+        # Room in the queue promised to deliveries which are being journaled, so that an event's deliveries are queued together
+        self.reserved = 0
+        self.reserved_lock = threading.Lock()
+
+        # Actions to run later (retries and releases of held deliveries), as a heap of (due time, sequence number, action)
+        self.scheduled = []
+        self.scheduled_condition = threading.Condition()
+        self.scheduled_sequence = itertools.count()
+
+        # Deliveries held back by the rate limiter, by destination
+        self.held = {}
+        self.held_lock = threading.Lock()
+
+    def __str__(self):
+        return 'WebhookHubDeliveryQueue(workers={0}, max_size={1}, max_attempts={2}, max_coalesce={3}{4}{5})'.format(self.workers, self.max_size,
+            self.max_attempts, self.max_coalesce, ', journal={0}'.format(self.journal) if self.journal else '',
+            ', rate_limiter={0}'.format(self.rate_limiter) if self.rate_limiter else '')
+
+    def start(self):
+        """Start the worker threads of this queue, unless they are already running in this process."""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.max_size)
+            self.reserved = 0
+            self.scheduled = []
+            self.held = {}
+
+            self.threads = [threading.Thread(target=self.work, name='webhookhub-delivery-{0}'.format(i), daemon=True) for i in range(self.workers)]
+            self.threads.append(threading.Thread(target=self.run_scheduled, name='webhookhub-scheduler', daemon=True))
+            for thread in self.threads:
+                thread.start()
+
+            # Replay deliveries left pending by processes which have exited
+            if self.journal:
+                records = self.journal.open()
+                for record in records:
+                    self.retry(WebhookHubDelivery.from_record(record), record['due'])
+                if records:
+                    sys.stderr.write('Replaying {0} pending deliveries from {1}\n'.format(len(records), self.journal))
+
+    def put(self, delivery):
+        """Queue a delivery, returning False if the queue is full."""
+        return self.put_all([delivery]) == 1
+
+    def put_all(self, deliveries):
+        """
+        Queue the deliveries of a webhook event (one per target) together, returning how many were queued: none of them
+        if the queue hasn't room for all of them, so that the origin can send the event again without any duplicates.
+        Retried and released deliveries don't wait for this check, so if they fill the queue meanwhile the rest are dropped.
+        """
+        self.start()
+
+        with self.reserved_lock:
+            if self.max_size > 0 and self.queue.qsize() + self.reserved + len(deliveries) > self.max_size:
+                return 0
+            self.reserved += len(deliveries)
+
+        queued = 0
+        for delivery in deliveries:
+            try:
+                if self.enqueue(delivery):
+                    queued += 1
+            finally:
+                with self.reserved_lock:
+                    self.reserved -= 1
+        return queued
+
+    def enqueue(self, delivery):
+        delivery = delivery._replace(id=uuid.uuid4().hex, attempt=0)
+        if self.journal:
+            self.journal.append(delivery.to_record(), wait=True)
+
+        try:
+            self.queue.put_nowait(delivery)
+            return True
+        except queue.Full:
+            self.finish(delivery)
+            return False
+
+    def size(self):
+        return self.queue.qsize() if self.queue else 0
+
+    def join(self, timeout=None):
+        """Wait for every queued delivery to be attempted, or until the timeout (in seconds) passes."""
+        if self.queue is None or self.pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                sys.stderr.write('Gave up waiting for {0} queued deliveries\n'.format(self.queue.unfinished_tasks))
+                break
+            time.sleep(0.05)
+
+        waiting = len(self.scheduled) + sum(len(held) for held in self.held.values())
+        if waiting:
+            sys.stderr.write('{0} deliveries or held destinations are still waiting{1}\n'.format(waiting, '' if self.journal else ' and will be lost'))
+        if self.journal:
+            self.journal.close()
+
+    def work(self):
+        while True:
+            delivery = self.queue.get()
+            try:
+                if not self.hold(delivery):
+                    self.deliver(delivery)
+            except Exception as e:
+                sys.stderr.write('Unexpected error delivering webhook event to {0}: {1}\n'.format(delivery.destination, e))
+                self.finish(delivery)
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, delivery):
+        retry_after = None
+        try:
+            response = self.delivery_client.post(delivery.destination, delivery.payload, connect_timeout=delivery.connect_timeout, read_timeout=delivery.read_timeout)
+        except requests.exceptions.RequestException as e:
+            sys.stderr.write('Failed to deliver queued webhook event to {0}: {1}\n'.format(delivery.destination, e))
+        else:
+            if self.rate_limiter:
+                self.rate_limiter.update(delivery.destination, response.status_code, response.headers)
+            if response.status_code != 429 and response.status_code < 500:
+                if response.status_code >= 400:
+                    sys.stderr.write('Destination {0} rejected queued webhook event with status {1}\n'.format(delivery.destination, response.status_code))
+                elif self.debug:
+                    print('delivered queued webhook event to {0}, status {1}'.format(delivery.destination, response.status_code))
+                self.finish(delivery)
+                return
+            sys.stderr.write('Destination {0} responded to queued webhook event with status {1}\n'.format(delivery.destination, response.status_code))
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+        attempt = delivery.attempt + 1
+        if attempt >= self.max_attempts:
+            sys.stderr.write('Dropping webhook event for {0} after {1} attempts\n'.format(delivery.destination, attempt))
+            self.finish(delivery)
+            return
+
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        due = time.time() + delay
+        if self.journal:
+            self.journal.append({'op': 'retry', 'id': delivery.id, 'attempt': attempt, 'due': due})
+        self.retry(delivery._replace(attempt=attempt), due)
+
+    def finish(self, delivery):
+        if self.journal:
+            self.journal.append({'op': 'done', 'id': delivery.id})
+
+    def retry(self, delivery, due):
+        """Schedule a delivery to be queued again at some time (in seconds since the epoch)."""
+        # Retried deliveries were already accepted, so wait for room in the queue rather than dropping them
+        self.schedule(due, lambda: self.queue.put(delivery))
+
+    def hold(self, delivery):
+        """Hold back a delivery if its destination is rate limited (or already has held deliveries), returning whether it was held."""
+        if not self.rate_limiter:
+            return False
+
+        with self.held_lock:
+            held = self.held.get(delivery.destination)
+            if held is not None:
+                held.append(delivery)
+                return True
+
+            # Held deliveries take their token once they are released, so none is reserved for them now
+            wait = self.rate_limiter.acquire(delivery.destination, max_wait=0)
+            if wait <= 0:
+                return False
+            self.held[delivery.destination] = [delivery]
+
+        if self.debug:
+            print('holding webhook events for {0} for {1:.2f} seconds'.format(delivery.destination, wait))
+        self.schedule(time.time() + wait, lambda: self.release(delivery.destination))
+        return True
+
+    def release(self, destination):
+        """Queue the deliveries held for a destination again, merging them if possible."""
+        with self.held_lock:
+            held = self.held.pop(destination, [])
+
+        for delivery in self.coalesce(held):
+            self.queue.put(delivery)
+
+    def coalesce(self, deliveries):
+        """
+        Merge consecutive deliveries whose payloads can be combined, up to max_coalesce payloads and MAX_MERGED_EMBEDS
+        embeds each, since a destination rejecting a merged delivery would lose every event merged into it.
+        """
+        if self.max_coalesce <= 1 or len(deliveries) <= 1:
+            return deliveries
+
+        groups = []
+        embeds = 0
+        for delivery in deliveries:
+            group = groups[-1] if groups else None
+            delivery_embeds = count_merged_items(delivery.payload)
+            if group and len(group) < self.max_coalesce and embeds + delivery_embeds <= MAX_MERGED_EMBEDS and can_merge_deliveries(group[0], delivery):
+                group.append(delivery)
+                embeds += delivery_embeds
+            else:
+                groups.append([delivery])
+                embeds = delivery_embeds
+
+        coalesced = []
+        for group in groups:
+            if len(group) == 1:
+                coalesced.append(group[0])
+                continue
+
+            merged = group[0]._replace(payload=merge_payloads([delivery.payload for delivery in group]), id=uuid.uuid4().hex, attempt=0)
+            if self.journal:
+                self.journal.append(merged.to_record(), wait=True)
+            for delivery in group:
+                self.finish(delivery)
+            if self.debug:
+                print('merged {0} webhook events for {1}'.format(len(group), merged.destination))
+            coalesced.append(merged)
+        return coalesced
+
+    def schedule(self, due, action):
+        """Run an action on the scheduler thread at some time (in seconds since the epoch)."""
+        with self.scheduled_condition:
+            heapq.heappush(self.scheduled, (due, next(self.scheduled_sequence), action))
+            self.scheduled_condition.notify()
+
+    def run_scheduled(self):
+        while True:
+            with self.scheduled_condition:
+                while not self.scheduled or self.scheduled[0][0] > time.time():
+                    self.scheduled_condition.wait(self.scheduled[0][0] - time.time() if self.scheduled else None)
+                _, _, action = heapq.heappop(self.scheduled)
+            action()
+
+
+def can_merge_deliveries(delivery, other):
+    if (delivery.connect_timeout, delivery.read_timeout) != (other.connect_timeout, other.read_timeout):
+        return False
+    return can_merge_payloads(decoded_payload(delivery.payload), decoded_payload(other.payload))
+
+
+def can_merge_payloads(payload, other):
+    """Payloads can be merged if they are identical apart from their lists of embeds (as in Discord messages)."""
+    if type(payload) != dict or type(other) != dict:
+        return False
+    if type(payload.get(MERGE_KEY)) != list or type(other.get(MERGE_KEY)) != list:
+        return False
+    return {k: v for k, v in payload.items() if k != MERGE_KEY} == {k: v for k, v in other.items() if k != MERGE_KEY}
+
+
+def merge_payloads(payloads):
+    """Merge payloads accepted by can_merge_payloads into one, concatenating their lists of embeds."""
+    payloads = [decoded_payload(payload) for payload in payloads]
+    merged = dict(payloads[0])
+    merged[MERGE_KEY] = [embed for payload in payloads for embed in payload[MERGE_KEY]]
+    return merged
+
+
+def count_merged_items(payload):
+    """Get the length of the list of a payload which is concatenated when merging it, if it has one."""
+    payload = decoded_payload(payload)
+    if type(payload) != dict or type(payload.get(MERGE_KEY)) != list:
+        return 0
+    return len(payload[MERGE_KEY])
+
+
+def decoded_payload(payload):
+    """Get a payload as JSON objects, deserializing it if it is a RenderedPayload."""
+    try:
+        return payload.decode() if type(payload) == RenderedPayload else payload
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt):
+    """Get the seconds to wait before some retry: exponential backoff, with half of it randomized to spread out retries."""
+    delay = min(MAX_RETRY_BACKOFF, BASE_RETRY_BACKOFF * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
@@ -0,0 +1,131 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import threading
+
+from src.parser import compile_template, WebhookHubParserError
+from src.template import SymbolNode, JSONSymbolNode, IfNode, ForNode
+
+
+__author__ = 'Evan Williams'
+
+
+# Kinds of config variables, by what their values depend on
+CONSTANT = 'constant'
+ENV_DEPENDENT = 'env'
+PAYLOAD_DEPENDENT = 'payload'
+
+
+class WebhookHubExpressionCache:
+    """
+    Caches the values of the config variables of an event configuration which don't depend on the payload, across
+    every webhook event. Variables are classified when the configuration is loaded: constant variables (made of text
+    and other constant variables) are evaluated once, environment-dependent variables once for each value of the
+    environment variables they use, and only payload-dependent variables are evaluated for every webhook event.
+    """
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.lock = threading.Lock()
+
+        # Kind and environment variable names of each config variable, and cached values as (environment key, value)
+        self.kinds = {}
+        self.env_names = {}
+        self.values = {}
+
+        for name in variables:
+            self.classify(name, ())
+
+    def __str__(self):
+        counts = [sum(1 for kind in self.kinds.values() if kind == k) for k in (CONSTANT, ENV_DEPENDENT, PAYLOAD_DEPENDENT)]
+        return 'WebhookHubExpressionCache({0} constant, {1} env-dependent, {2} payload-dependent)'.format(*counts)
+
+    def classify(self, name, classifying):
+        """Classify a config variable, along with every variable it refers to, returning its kind."""
+        if name in self.kinds:
+            return self.kinds[name]
+        if name in classifying:
+            # Left for rendering to report the cycle
+            return PAYLOAD_DEPENDENT
+
+        variable = self.variables.get(name)
+        kind = CONSTANT
+        env_names = set()
+        if variable and '$' in variable:
+            try:
+                nodes = compile_template(variable).nodes
+            except (SyntaxError, WebhookHubParserError):
+                # Left for rendering to report the error
+                nodes = None
+            if nodes is None:
+                kind = PAYLOAD_DEPENDENT
+            else:
+                for symbol in template_symbols(nodes):
+                    first_component, _, rest = symbol.partition('.')
+                    if first_component == 'env':
+                        env_names.add(rest)
+                    elif first_component == 'config':
+                        referenced = rest.lower()
+                        referenced_kind = self.classify(referenced, classifying + (name,))
+                        if referenced_kind == PAYLOAD_DEPENDENT:
+                            kind = PAYLOAD_DEPENDENT
+                        env_names.update(self.env_names.get(referenced, ()))
+                    else:
+                        kind = PAYLOAD_DEPENDENT
+
+        if kind == CONSTANT and env_names:
+            kind = ENV_DEPENDENT
+        self.kinds[name] = kind
+        self.env_names[name] = tuple(sorted(env_names))
+        return kind
+
+    def get_key(self, name):
+        """Get the key a variable's value is cached under, which changes with its environment variables, or None if it isn't cached."""
+        kind = self.kinds.get(name, PAYLOAD_DEPENDENT)
+        if kind == PAYLOAD_DEPENDENT:
+            return None
+        elif kind == CONSTANT:
+            return ()
+        return tuple(os.environ.get(env_name) for env_name in self.env_names[name])
+
+    def get(self, name, key):
+        """Get the cached value of a variable for some key (see get_key), or None if there is none."""
+        cached = self.values.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        return None
+
+    def put(self, name, key, value):
+        with self.lock:
+            self.values[name] = (key, value)
+
+
+def template_symbols(nodes):
+    for node in nodes:
+        if type(node) in [SymbolNode, JSONSymbolNode]:
+            yield node.symbol
+        elif type(node) == IfNode:
+            yield node.symbol
+            yield from template_symbols(node.body)
+            yield from template_symbols(node.orelse)
+        elif type(node) == ForNode:
+            yield node.symbol
+            yield from template_symbols(node.body)
@@ -0,0 +1,220 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+
+__author__ = 'Evan Williams'
+
+
+SEGMENT_SUFFIX = '.journal'
+
+# Size in bytes after which a process starts a new segment, carrying over only its pending deliveries
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+
+class WebhookHubJournal:
+    """
+    A write-ahead journal of queued deliveries, stored in a directory as append-only segments of JSON lines.
+
+    Each process appends to its own segment, which it keeps locked while running. Records are written by a
+    single thread and fsync'd once per batch, so concurrent appends share the cost of each fsync. Segments
+    left behind by processes which have exited are claimed, and their pending deliveries replayed, by the
+    next process to open the journal.
+
+    Records are one of:
+    - {"op": "put", "id": ..., "attempt": ..., "due": ..., ...delivery fields}: a delivery was queued
+    - {"op": "retry", "id": ..., "attempt": ..., "due": ...}: a delivery failed and will be retried at "due"
+    - {"op": "done", "id": ...}: a delivery succeeded or was abandoned
+    """
+
+    def __init__(self, directory, max_segment_size=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.max_segment_size = max_segment_size
+
+        self.segment = None
+        self.segment_path = None
+        self.pending = {}
+        self.batch = []
+        self.closing = False
+        self.condition = threading.Condition()
+        self.writer = None
+
+    def __str__(self):
+        return 'WebhookHubJournal({0})'.format(self.directory)
+
+    def open(self):
+        """Open a new segment for this process, returning the pending delivery records recovered from orphaned segments."""
+        os.makedirs(self.directory, exist_ok=True)
+
+        recovered = {}
+        orphans = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            orphan = self.claim_segment(os.path.join(self.directory, name))
+            if orphan is not None:
+                recovered.update(read_pending_records(orphan))
+                orphans.append(orphan)
+
+        self.segment, self.segment_path = self.create_segment()
+
+        # Carry the recovered deliveries over to this process's segment before removing the orphans
+        self.write_records(recovered.values())
+        for orphan in orphans:
+            os.unlink(orphan.name)
+            orphan.close()
+        self.sync_directory()
+
+        self.writer = threading.Thread(target=self.write, name='webhookhub-journal', daemon=True)
+        self.writer.start()
+
+        return list(recovered.values())
+
+    def append(self, record, wait=False):
+        """
+        Append a record, optionally waiting until the batch it is written in has been fsync'd.
+        Records appended once the journal is closing are dropped, as its writer thread has stopped (or is about to),
+        which leaves the deliveries they describe pending and so replayed by the next process.
+        """
+        event = threading.Event() if wait else None
+        with self.condition:
+            if self.closing:
+                return
+            self.batch.append((record, event))
+            self.condition.notify()
+        if event:
+            event.wait()
+
+    def close(self):
+        """Write any remaining records and close this process's segment, leaving its pending deliveries to be replayed."""
+        if self.writer is None:
+            return
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.writer.join()
+
+        # Nothing is left to replay from a segment without pending deliveries
+        if not self.pending:
+            os.unlink(self.segment_path)
+        self.segment.close()
+
+    def write(self):
+        while True:
+            with self.condition:
+                while not self.batch and not self.closing:
+                    self.condition.wait()
+                if not self.batch:
+                    return
+                batch, self.batch = self.batch, []
+
+            try:
+                self.write_records([record for record, _ in batch])
+            except OSError as e:
+                sys.stderr.write('Failed to write delivery journal {0}: {1}\n'.format(self.segment_path, e))
+
+            for _, event in batch:
+                if event:
+                    event.set()
+
+            if self.segment.tell() > self.max_segment_size:
+                self.rotate()
+
+    def write_records(self, records):
+        for record in records:
+            self.segment.write(json.dumps(record, separators=(',', ':')))
+            self.segment.write('\n')
+            apply_record(self.pending, record)
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+
+    def rotate(self):
+        """Replace this process's segment with a new one containing only its pending deliveries."""
+        old_segment, old_segment_path = self.segment, self.segment_path
+        self.segment, self.segment_path = self.create_segment()
+        pending, self.pending = self.pending, {}
+        self.write_records(pending.values())
+        os.unlink(old_segment_path)
+        old_segment.close()
+        self.sync_directory()
+
+    def create_segment(self):
+        # A segment is locked before it is given its final name, so no other process can mistake it for an orphan
+        name = '{0}-{1}'.format(os.getpid(), time.time_ns())
+        temporary_path = os.path.join(self.directory, name + '.tmp')
+        path = os.path.join(self.directory, name + SEGMENT_SUFFIX)
+
+        segment = open(temporary_path, 'a', encoding='utf-8')
+        fcntl.flock(segment, fcntl.LOCK_EX)
+        os.rename(temporary_path, path)
+        return segment, path
+
+    def claim_segment(self, path):
+        """Lock a segment whose process has exited, returning it open for reading, or None if it is in use or gone."""
+        try:
+            segment = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+
+        try:
+            fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Another process may have claimed and removed this segment after it was opened
+            if os.fstat(segment.fileno()).st_ino != os.stat(path).st_ino:
+                raise FileNotFoundError(path)
+        except (BlockingIOError, FileNotFoundError):
+            segment.close()
+            return None
+
+        return segment
+
+    def sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def apply_record(pending, record):
+    """Apply a journal record to a dictionary of pending "put" records keyed by delivery id."""
+    op = record.get('op')
+    if op == 'put':
+        pending[record['id']] = record
+    elif op == 'retry' and record['id'] in pending:
+        pending[record['id']] = dict(pending[record['id']], attempt=record['attempt'], due=record['due'])
+    elif op == 'done':
+        pending.pop(record['id'], None)
+
+
+def read_pending_records(segment):
+    pending = {}
+    for line in segment:
+        try:
+            apply_record(pending, json.loads(line))
+        except (ValueError, KeyError):
+            # A process that crashed mid-write may leave a truncated final line
+            continue
+    return pending
@@ -18,12 +18,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import copy
 import ply.lex as lex
 
 
 __author__ = 'Evan Williams'
 
 
+SINGLE_CHARACTER_TEXT = r'.|\s'
+
+
 class WebhookHubLexer:
 	states = (
 		('text', 'exclusive'),
@@ -34,7 +38,10 @@ class WebhookHubLexer:
 		'ENDFOR', 'SHORTCUT_VARIABLE', 'INJ_END', 'TEXT', 'ESCAPED_CHAR')
 	
 	t_INITIAL_text_SHORTCUT_VARIABLE = r'\$(?:data|config|env|key)(?:\.[\w\-]+)*'
-	t_INITIAL_text_TEXT = r'.|\s'
+	# Literal text is lexed in maximal runs, stopping at any "$" or "\" that may start a shortcut variable,
+	# an injection or an escaped character (and at "}" in the text state), with single characters as a fallback
+	t_INITIAL_TEXT = r'[^$\\]+|[\s\S]'
+	t_text_TEXT = r'[^$\\}]+|[\s\S]'
 	t_inj_VARIABLE = r'(?:data|config|env|key)(?:\.[\w\-]+)*'
 	t_inj_IF = r'if'
 	t_inj_NOT = r'not'
@@ -46,8 +53,13 @@ class WebhookHubLexer:
 	t_inj_ENDFOR = r'endfor'
 	t_inj_ignore = ' '
 
-	def __init__(self, **kwargs):
+	def __init__(self, text_runs=True, **kwargs):
+		# Without text runs, every character of literal text is lexed as its own TEXT token
+		if not text_runs:
+			self.t_INITIAL_TEXT = self.t_text_TEXT = SINGLE_CHARACTER_TEXT
 		self.lexer = lex.lex(module=self, **kwargs)
+		# Number of tokens lexed from the input so far
+		self.token_count = 0
 
 	def t_INITIAL_text_INJ_START(self, t):
 		r'\$\{'
@@ -72,8 +84,18 @@ class WebhookHubLexer:
 	def t_ANY_error(self, t):
 		raise SyntaxError('Illegal character "{0}"'.format(t.value[0]))
 
+	def clone(self):
+		"""Returns a copy of this lexer with its own input state, sharing the compiled master regex."""
+		cloned = copy.copy(self)
+		cloned.lexer = self.lexer.clone()
+		cloned.token_count = 0
+		return cloned
+
 	def token(self):
-		return self.lexer.token()
+		token = self.lexer.token()
+		if token is not None:
+			self.token_count += 1
+		return token
 
 	def input(self, input_text):
 		self.lexer.input(input_text)
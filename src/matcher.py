@@ -0,0 +1,108 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import re
+
+
+__author__ = 'Evan Williams'
+
+
+class WebhookHubRouteMatcher:
+    """
+    Selects the route of incoming requests, using indexes built once from the loaded routes.
+
+    Routes are ranked by their priority (highest first), then by the order they were loaded in, and a request is
+    routed to the best ranked route that matches it. A route matches a request if any of its explicit matchers
+    (match-path-prefix, match-header or match-header-regex) does, or if its agent appears in the User-Agent header
+    (or, for requests without one, in the name of any header).
+    """
+
+    def __init__(self, routes):
+        ranked_routes = sorted(enumerate(routes), key=lambda item: (-item[1].priority, item[0]))
+        self.routes = [route for _, route in ranked_routes]
+
+        # Explicit matchers by path prefix and by lowercased header name, as (rank, value or regex)
+        self.path_prefixes = {}
+        self.headers = {}
+        self.header_regexes = {}
+        for rank, route in enumerate(self.routes):
+            for prefix in route.match_path_prefixes:
+                self.path_prefixes.setdefault(prefix.rstrip('/'), rank)
+            for name, value in route.match_headers:
+                self.headers.setdefault(name, []).append((rank, value))
+            for name, regex in route.match_header_regexes:
+                self.header_regexes.setdefault(name, []).append((rank, regex))
+
+        # A single pattern finding every (possibly overlapping) agent, where the best ranked agent wins at each position
+        agents = ['(?P<r{0}>{1})'.format(rank, re.escape(route.agent.lower())) for rank, route in enumerate(self.routes) if route.agent]
+        self.agent_pattern = re.compile('(?=(?:{0}))'.format('|'.join(agents))) if agents else None
+
+    def __str__(self):
+        return 'WebhookHubRouteMatcher({0} routes)'.format(len(self.routes))
+
+    def match(self, path, headers):
+        """Get the route for a request path and its headers (an email.message.Message), or None if there is none."""
+        user_agent = headers.get('User-Agent')
+        ranks = [
+            self.match_explicit(path, headers),
+            self.match_agent(user_agent if user_agent is not None else '\n'.join(headers.keys())),
+        ]
+        rank = min((rank for rank in ranks if rank is not None), default=None)
+
+        return self.routes[rank] if rank is not None else None
+
+    def match_explicit(self, path, headers):
+        best = None
+
+        if self.path_prefixes and path:
+            # Look up every prefix of the path that ends on a "/" boundary
+            path = path.split('?', 1)[0].rstrip('/')
+            while True:
+                rank = self.path_prefixes.get(path)
+                if rank is not None and (best is None or rank < best):
+                    best = rank
+                if not path:
+                    break
+                path = path[:max(path.rfind('/'), 0)]
+
+        if self.headers or self.header_regexes:
+            for name, value in headers.items():
+                name = name.lower()
+                for rank, expected in self.headers.get(name, ()):
+                    if (best is None or rank < best) and (expected is None or expected == value):
+                        best = rank
+                for rank, regex in self.header_regexes.get(name, ()):
+                    if (best is None or rank < best) and regex.search(value):
+                        best = rank
+
+        return best
+
+    def match_agent(self, text):
+        if self.agent_pattern is None:
+            return None
+
+        best = None
+        for match in self.agent_pattern.finditer(text.lower()):
+            rank = int(match.lastgroup[1:])
+            if best is None or rank < best:
+                best = rank
+                if best == 0:
+                    break
+        return best
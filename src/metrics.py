@@ -0,0 +1,148 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import bisect
+import threading
+
+
+__author__ = 'Evan Williams'
+
+
+# Upper bounds in seconds of the buckets of every latency histogram, from fast renders to slow destinations
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, along with their sum, as Prometheus histograms keep them."""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Counts per bucket (not cumulative), the last of which is for values above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class WebhookHubMetrics:
+    """
+    Counters, gauges and fixed-bucket histograms, each kept per combination of label values and exposed in the
+    Prometheus text format. Recording a value is a dictionary lookup and an addition under a lock, so metrics are
+    always kept (unlike debug logging). With pre-forked worker processes, each worker keeps its own metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Metrics by name, as (kind, help text, label names, values by label values)
+        self.metrics = {}
+        # Functions giving the current value of each gauge (or of each labeled counter kept elsewhere)
+        self.collectors = {}
+
+    def __str__(self):
+        return 'WebhookHubMetrics({0} metrics)'.format(len(self.metrics) + len(self.collectors))
+
+    def counter(self, name, help_text, labels=()):
+        self.metrics[name] = ('counter', help_text, labels, {})
+
+    def histogram(self, name, help_text, labels=()):
+        self.metrics[name] = ('histogram', help_text, labels, {})
+
+    def gauge(self, name, help_text, collect, labels=()):
+        """Define a metric whose values are collected when exposed, as a dictionary by label values (or a single number)."""
+        self.collectors[name] = ('gauge', help_text, labels, collect)
+
+    def collected_counter(self, name, help_text, collect, labels=()):
+        """Define a counter kept elsewhere, whose values are collected when exposed like those of a gauge."""
+        self.collectors[name] = ('counter', help_text, labels, collect)
+
+    def increment(self, name, label_values=(), amount=1):
+        values = self.metrics[name][3]
+        with self.lock:
+            values[label_values] = values.get(label_values, 0) + amount
+
+    def observe(self, name, label_values, value):
+        values = self.metrics[name][3]
+        with self.lock:
+            histogram = values.get(label_values)
+            if histogram is None:
+                histogram = values[label_values] = Histogram()
+            histogram.observe(value)
+
+    def expose(self):
+        """Get every metric in the Prometheus text format."""
+        lines = []
+
+        with self.lock:
+            for name, (kind, help_text, labels, values) in self.metrics.items():
+                lines.append('# HELP {0} {1}'.format(name, help_text))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                for label_values, value in sorted(values.items()):
+                    if kind == 'histogram':
+                        lines.extend(format_histogram(name, labels, label_values, value))
+                    else:
+                        lines.append(format_sample(name, labels, label_values, value))
+
+        for name, (kind, help_text, labels, collect) in self.collectors.items():
+            values = collect()
+            if type(values) != dict:
+                values = {(): values}
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for label_values, value in sorted(values.items()):
+                lines.append(format_sample(name, labels, label_values, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_histogram(name, labels, label_values, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(format_sample(name + '_bucket', labels + ('le',), label_values + (format_value(bound),), cumulative))
+    lines.append(format_sample(name + '_bucket', labels + ('le',), label_values + ('+Inf',), histogram.count))
+    lines.append(format_sample(name + '_sum', labels, label_values, histogram.sum))
+    lines.append(format_sample(name + '_count', labels, label_values, histogram.count))
+    return lines
+
+
+def format_sample(name, labels, label_values, value):
+    if not labels:
+        return '{0} {1}'.format(name, format_value(value))
+    label_text = ','.join('{0}="{1}"'.format(label, escape_label_value(str(label_value))) for label, label_value in zip(labels, label_values))
+    return '{0}{{{1}}} {2}'.format(name, label_text, format_value(value))
+
+
+def format_value(value):
+    if type(value) == int:
+        return str(value)
+    return repr(float(value))
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -18,14 +18,17 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import itertools
+import functools
 import json
 import os
 import ply.yacc as yacc
 import re
 import sys
+import threading
 
+from src import tracing
 from src.lexer import WebhookHubLexer
+from src.template import WebhookHubTemplate, TextNode, SymbolNode, IfNode, ForNode, merge_text_nodes
 
 
 __author__ = 'Evan Williams'
@@ -35,30 +38,42 @@ CONFIG_PATTERN = re.compile(r'^config\.')
 ENV_PATTERN = re.compile(r'^env\.')
 KEY_PATTERN = re.compile(r'^key\.')
 
+# Maximum number of distinct texts (templates and config expressions) kept compiled in memory
+TEMPLATE_CACHE_SIZE = 1024
 
-class WebhookHubParser:
-    # Top-level nonterminal to parse
-    start = 'items'
 
-    # Used to ensure text is parsed correctly before an INJ_START token
-    precedence = (
-        ('left', 'INJ_START'),
-        ('left', 'TEXT')
-    )
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(text):
+    """
+    Compile some text using the WebhookHub template syntax into a reusable WebhookHubTemplate.
+    Compiled templates are cached, so the same text is only ever lexed and parsed once.
+
+    >>> template = compile_template('Hello, $data.a.b!')
+    >>> template.render(WebhookHubParserContext(payload={'a': {'b': 'world'}}))
+    'Hello, world!'
+    """
+    return WebhookHubParser.shared().compile(text)
+
+
+class WebhookHubParserContext:
+    """
+    The per-evaluation state used when rendering compiled templates (payload, event configuration).
+    Contexts are cheap to create, so use a new one for every webhook event.
+
+    Config variables are evaluated at most once per context (and once more if also rendered into JSON, when they
+    are escaped for it): their values are memoized, and the stack of variables being evaluated is used to detect
+    reference cycles between them.
+    """
 
     def __init__(self, payload=None, event_config=None):
         self.payload = payload
         self.event_config = event_config
 
-        # Configure this parser as a wrapper around a PLY lexer and parser
-        self.lexer = WebhookHubLexer()
-        self.tokens = self.lexer.tokens
-        self.parser = yacc.yacc(module=self)
-
-        # For-loop key indexing information
-        self.index_symbol_table = {}
-        self.index_symbol_stack = []
-        self.num_index_combinations = 1
+        # Config variable values by lowercased name and whether they were rendered as JSON strings, and the
+        # variables being evaluated
+        self.config_values = {}
+        self.config_stack = []
+        self.as_json = False
 
     def parse(self, text):
         """
@@ -66,23 +81,16 @@ class WebhookHubParser:
         Returns None if there is an error or no text is provided.
 
         >>> payload = {'a': {'b': 'Foo'}}
-        >>> parser = WebhookHubParser(payload=payload)
-        >>> parser.parse('$data.a.b')
+        >>> context = WebhookHubParserContext(payload=payload)
+        >>> context.parse('$data.a.b')
         'Foo'
-        >>> parser.parse('$data.x.y')
+        >>> context.parse('$data.x.y')
         None
         """
         if not text:
             return None
         try:
-            result = self.parser.parse(text, lexer=self.lexer)
-            if type(result) == list and len(result) == 1:
-                return result[0]
-            elif result is None:
-                return None
-            else:
-                sys.stderr.write('For-loop branching error during parsing: {0}\n'.format(str(result)))
-                return None
+            return compile_template(text).render(self)
         except WebhookHubParserError as e:
             sys.stderr.write('Failed to parse input: {0}\n'.format(e))
             return None
@@ -90,6 +98,22 @@ class WebhookHubParser:
             sys.stderr.write('SyntaxError: {0}\n'.format(e))
             return None
 
+    def render(self, template, as_json=False):
+        """
+        Render an already compiled WebhookHubTemplate in this context, optionally as JSON (see WebhookHubTemplate.render_json).
+        Returns None if there is an error.
+        """
+        try:
+            if as_json:
+                self.as_json = True
+                return template.render_json(self)
+            return template.render(self)
+        except WebhookHubParserError as e:
+            sys.stderr.write('Failed to render template: {0}\n'.format(e))
+            return None
+        finally:
+            self.as_json = False
+
     # Symbol evaluation methods
 
     def evaluate_symbol(self, symbol, index_context={}, stringify=False):
@@ -163,17 +187,68 @@ class WebhookHubParser:
         if not self.event_config:
             raise WebhookHubParserError('this parsing context has no event configuration')
 
-        config_property = re.sub(CONFIG_PATTERN, '', symbol)
-        variable = self.event_config.get_variable(config_property)
+        config_property = re.sub(CONFIG_PATTERN, '', symbol).lower()
+        tracing.count('config symbols evaluated')
+
+        name = (config_property, self.as_json)
+        if name in self.config_values:
+            value = self.config_values[name]
+        else:
+            value = self.config_values[name] = self.evaluate_config_variable(config_property)
 
-        parser = WebhookHubParser(payload=self.payload, event_config=self.event_config)
-        value = parser.parse(variable)
-        
         if value is None:
             return '' if stringify else None
 
         return value
 
+    def evaluate_config_variable(self, config_property):
+        if config_property in self.config_stack:
+            cycle = self.config_stack[self.config_stack.index(config_property):] + [config_property]
+            raise WebhookHubConfigCycleError('config variables refer to each other: {0}'.format(' -> '.join(cycle)))
+
+        variable = self.event_config.get_variable(config_property)
+        if not variable:
+            return None
+
+        # Variables which don't depend on the payload are cached by the event configuration across webhook events
+        # (separately for values escaped as JSON strings)
+        expression_cache = getattr(self.event_config, 'expression_cache', None)
+        key = expression_cache.get_key(config_property) if expression_cache is not None else None
+        if key is not None:
+            value = expression_cache.get((config_property, self.as_json), key)
+            if value is not None:
+                return value
+
+        tracing.count('config variables rendered')
+        self.config_stack.append(config_property)
+        try:
+            template = compile_template(variable)
+            value = template.render_string(self) if self.as_json else template.render(self)
+            if key is not None:
+                expression_cache.put((config_property, self.as_json), key, value)
+            return value
+        except WebhookHubConfigCycleError:
+            raise
+        except WebhookHubParserError as e:
+            sys.stderr.write('Failed to parse input: {0}\n'.format(e))
+            return None
+        except SyntaxError as e:
+            sys.stderr.write('SyntaxError: {0}\n'.format(e))
+            return None
+        finally:
+            self.config_stack.pop()
+
+    def get_indexes(self, symbol, index_context={}):
+        """Get the for-loop keys of some list or dictionary symbol."""
+        l = self.evaluate_symbol(symbol, index_context=index_context)
+        if type(l) not in [list, dict]:
+            raise WebhookHubParserError('symbol "{0}" is neither a list nor a dictionary'.format(symbol))
+
+        tracing.count('loop iterations', len(l))
+        if type(l) == list:
+            return tuple(range(len(l)))
+        return tuple(l.keys())
+
     def evaluate_env_symbol(self, symbol):
         env_property = re.sub(ENV_PATTERN, '', symbol)
         value = os.getenv(env_property)
@@ -190,57 +265,88 @@ class WebhookHubParser:
         key = re.sub(KEY_PATTERN, '', symbol)
         return index_context.get(key, '' if stringify else None)
 
-    # Methods to handle for-loop key indexing
-
-    def put_index_symbol(self, symbol, indexes):
-        """Adds a for-loop key to the stack."""
-        if symbol in self.index_symbol_table:
-            raise WebhookHubParserError('cannot add index symbol "{0}", it already exists'.format(symbol))
-
-        self.index_symbol_table[symbol] = indexes
-        self.index_symbol_stack.append(symbol)
-        self.num_index_combinations *= len(indexes)
-
-    def remove_index_symbol(self, symbol):
-        """Removes a for-loop key from the stack."""
-        if symbol not in self.index_symbol_table:
-            raise WebhookHubParserError('cannot remove index symbol "{0}", it doesn\'t exist'.format(symbol))
-
-        self.num_index_combinations //= len(self.index_symbol_table[symbol])
-        self.index_symbol_stack.pop()
-        del self.index_symbol_table[symbol]
 
-    def get_index_context(self, combination_index):
-        """Get the values of all present for-loop keys for some for-loop context."""
-        if combination_index < 0 or combination_index >= self.num_index_combinations:
-            raise WebhookHubParserError('invalid for-loop combination index: {0}'.format(combination_index))
+class WebhookHubParser:
+    # Top-level nonterminal to parse
+    start = 'items'
 
-        if len(self.index_symbol_stack) == 0:
-            return {}
+    # Used to ensure text is parsed correctly before an INJ_START token
+    precedence = (
+        ('left', 'INJ_START'),
+        ('left', 'TEXT')
+    )
 
-        index_lists = [self.index_symbol_table[symbol] for symbol in self.index_symbol_stack]
-        index_combination = list(itertools.product(*index_lists))[combination_index]
-        return {symbol: index_combination[i] for i, symbol in enumerate(self.index_symbol_stack)}
+    # The process-wide parser instance, see WebhookHubParser.shared()
+    _shared = None
+    _shared_lock = threading.Lock()
 
-    # Parsing grammar definitions
+    def __init__(self, text_runs=True):
+        # Configure this parser as a wrapper around a PLY lexer and parser.
+        # The LALR tables are kept in memory only, so no parser.out or parsetab module is read or written.
+        self.lexer = WebhookHubLexer(text_runs=text_runs)
+        self.tokens = self.lexer.tokens
+        self.parser = yacc.yacc(module=self, debug=False, write_tables=False)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Get the parser shared by the whole process, building its lexer and LALR tables on first use."""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls()
+        return cls._shared
+
+    def compile(self, text):
+        """
+        Compile some text using the WebhookHub template syntax into a render plan.
+        Prefer compile_template, which caches the resulting WebhookHubTemplate.
+        """
+        if not text:
+            return WebhookHubTemplate(text, [])
+
+        # Each compilation lexes with a fresh clone of the (never used) master lexer,
+        # so an input that failed mid-injection cannot leave a lexer state behind
+        lexer = self.lexer.clone()
+        with self.lock:
+            nodes = self.parser.parse(text, lexer=lexer)
+        tracing.count('templates compiled')
+        tracing.count('tokens lexed', lexer.token_count)
+
+        self.check_index_symbols(nodes, set())
+        return WebhookHubTemplate(text, merge_text_nodes(nodes))
+
+    def check_index_symbols(self, nodes, index_symbols):
+        """Ensures that nested for-loops never reuse the key of an enclosing for-loop."""
+        for node in nodes:
+            if type(node) == IfNode:
+                self.check_index_symbols(node.body, index_symbols)
+                self.check_index_symbols(node.orelse, index_symbols)
+            elif type(node) == ForNode:
+                if node.index_symbol in index_symbols:
+                    raise WebhookHubParserError('cannot add index symbol "{0}", it already exists'.format(node.index_symbol))
+                self.check_index_symbols(node.body, index_symbols | {node.index_symbol})
+
+    # Parsing grammar definitions, each of which builds a node of the render plan
 
     def p_items_multiple(self, p):
         'items : items item'
-        p[0] = ['{0}{1}'.format(p[1][i], p[2][i]) for i in range(self.num_index_combinations)]
+        p[1].append(p[2])
+        p[0] = p[1]
 
     def p_items_one(self, p):
         'items : item'
-        p[0] = p[1]
+        p[0] = [p[1]]
 
     def p_item_text(self, p):
         'item : TEXT'
-        p[0] = [str(p[1])] * self.num_index_combinations
+        p[0] = TextNode(str(p[1]))
 
     def p_item_escaped(self, p):
         'item : ESCAPED_CHAR'
         if len(p[1]) != 2:
             raise WebhookHubParserError('escaped character "{0}" is invalid'.format(p[1]))
-        p[0] = [p[1][1]] * self.num_index_combinations
+        p[0] = TextNode(p[1][1])
 
     def p_item_injection(self, p):
         'item : injection'
@@ -248,52 +354,47 @@ class WebhookHubParser:
 
     def p_item_shortcut(self, p):
         'item : SHORTCUT_VARIABLE'
-        p[0] = [self.evaluate_symbol(p[1].replace('$', '', 1), index_context=self.get_index_context(i), stringify=True) for i in range(self.num_index_combinations)]
+        p[0] = SymbolNode(p[1].replace('$', '', 1))
 
     def p_injection_variable(self, p):
         'injection : INJ_START VARIABLE INJ_END'
-        p[0] = [self.evaluate_symbol(p[2], index_context=self.get_index_context(i), stringify=True) for i in range(self.num_index_combinations)]
+        p[0] = SymbolNode(p[2])
 
     def p_injection_if(self, p):
         'injection : INJ_START IF VARIABLE INJ_END items INJ_START ENDIF INJ_END'
-        p[0] = [p[5][i] if self.evaluate_symbol(p[3], index_context=self.get_index_context(i)) else '' for i in range(self.num_index_combinations)]
+        p[0] = IfNode(p[3], False, tuple(p[5]), ())
 
     def p_injection_if_not(self, p):
         'injection : INJ_START IF NOT VARIABLE INJ_END items INJ_START ENDIF INJ_END'
-        p[0] =  ['' if self.evaluate_symbol(p[4], index_context=self.get_index_context(i)) else p[6][i] for i in range(self.num_index_combinations)]
+        p[0] = IfNode(p[4], True, tuple(p[6]), ())
 
     def p_injection_if_else(self, p):
         'injection : INJ_START IF VARIABLE INJ_END items INJ_START ELSE INJ_END items INJ_START ENDIF INJ_END'
-        p[0] = [p[5][i] if self.evaluate_symbol(p[3], index_context=self.get_index_context(i)) else p[9][i] for i in range(self.num_index_combinations)]
+        p[0] = IfNode(p[3], False, tuple(p[5]), tuple(p[9]))
 
     def p_injection_for(self, p):
         'injection : beginfor items INJ_START ENDFOR INJ_END'
-
-        self.remove_index_symbol(p[1]['symbol'])
-
-        # Join chunks for this for loop (e.g. [0, 1, 2, 3, 4, 5] -> [01, 23, 45])
-        n = len(p[2]) // self.num_index_combinations  # Size of each chunk
-        p[0] = [''.join(p[2][i * n : i * n + n]) for i in range(self.num_index_combinations)]
+        p[0] = ForNode(p[1]['symbol'], p[1]['variable'], tuple(p[2]))
 
     def p_injection_begin_for(self, p):
         'beginfor : INJ_START FOR INDEX_VAR IN VARIABLE INJ_END'
 
-        # TODO: Allow using for-loop keys to create other for-loops, currently not possible
-
-        l = self.evaluate_symbol(p[5])
-        if type(l) not in [list, dict]:
-            raise WebhookHubParserError('symbol "{0}" is neither a list nor a dictionary'.format(p[5]))
-
-        if type(l) == list:
-            self.put_index_symbol(p[3], tuple(range(len(l))))
-        elif type(l) == dict:
-            self.put_index_symbol(p[3], tuple(l.keys()))
-
         p[0] = {
-            'symbol': p[3]
+            'symbol': p[3],
+            'variable': p[5]
         }
 
+    def p_error(self, p):
+        if p is None:
+            raise SyntaxError('Unexpected end of input')
+        raise SyntaxError('Unexpected {0} "{1}" at position {2}'.format(p.type, p.value, p.lexpos))
+
 
 class WebhookHubParserError(Exception):
     def __init__(self, message):
         super().__init__(message)
+
+
+class WebhookHubConfigCycleError(WebhookHubParserError):
+    def __init__(self, message):
+        super().__init__(message)
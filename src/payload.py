@@ -0,0 +1,132 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+
+
+__author__ = 'Evan Williams'
+
+
+# Maximum size in bytes of a webhook event payload (GitHub caps its payloads at 25 MB)
+DEFAULT_MAX_PAYLOAD_SIZE = 25 * 1024 * 1024
+
+# Size of the reads of a body whose length isn't known in advance
+READ_CHUNK_SIZE = 64 * 1024
+
+# Maximum length of the size line (and any extensions) of a chunk, or of a trailer line
+MAX_CHUNK_LINE = 4096
+
+
+def load_json_backend():
+    """Get the name and loads() function of the fastest installed JSON library, all of which decode UTF-8 bytes directly."""
+    try:
+        import orjson
+        return ('orjson', orjson.loads)
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return ('ujson', ujson.loads)
+    except ImportError:
+        pass
+    return ('json', json.loads)
+
+
+JSON_BACKEND, json_loads = load_json_backend()
+
+
+def decode_payload(data):
+    """Decode a payload from the UTF-8 JSON bytes of a request body."""
+    try:
+        return json_loads(data)
+    except ValueError:
+        # Every backend's decoding errors (and UnicodeDecodeError) are ValueErrors
+        raise WebhookHubPayloadError('Unable to read webhook event payload', 400)
+
+
+def read_body(rfile, headers, max_size=DEFAULT_MAX_PAYLOAD_SIZE):
+    """
+    Read the body of a request, whether it has a Content-Length or uses chunked transfer encoding, raising a
+    WebhookHubPayloadError (413) as soon as it is known to be larger than max_size bytes.
+    """
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        return read_chunked_body(rfile, max_size)
+
+    if 'Content-Length' in headers:
+        try:
+            length = int(headers['Content-Length'])
+        except ValueError:
+            raise WebhookHubPayloadError('Invalid Content-Length', 400)
+        if length < 0:
+            raise WebhookHubPayloadError('Invalid Content-Length', 400)
+        if length > max_size:
+            raise WebhookHubPayloadError('Webhook event payload is larger than {0} bytes'.format(max_size), 413)
+        data = rfile.read(length)
+        if len(data) < length:
+            raise WebhookHubPayloadError('Incomplete webhook event payload', 400)
+        return data
+
+    # Without either, the body ends when the connection does
+    chunks = []
+    size = 0
+    while True:
+        chunk = rfile.read1(READ_CHUNK_SIZE) if hasattr(rfile, 'read1') else rfile.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return b''.join(chunks)
+        size += len(chunk)
+        if size > max_size:
+            raise WebhookHubPayloadError('Webhook event payload is larger than {0} bytes'.format(max_size), 413)
+        chunks.append(chunk)
+
+
+def read_chunked_body(rfile, max_size):
+    chunks = []
+    size = 0
+    while True:
+        line = rfile.readline(MAX_CHUNK_LINE + 1)
+        if len(line) > MAX_CHUNK_LINE or not line.endswith(b'\n'):
+            raise WebhookHubPayloadError('Invalid chunked webhook event payload', 400)
+        try:
+            chunk_size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise WebhookHubPayloadError('Invalid chunked webhook event payload', 400)
+
+        if chunk_size == 0:
+            break
+        size += chunk_size
+        if size > max_size:
+            raise WebhookHubPayloadError('Webhook event payload is larger than {0} bytes'.format(max_size), 413)
+
+        chunk = rfile.read(chunk_size)
+        if len(chunk) < chunk_size or rfile.readline(MAX_CHUNK_LINE + 1).strip():
+            raise WebhookHubPayloadError('Invalid chunked webhook event payload', 400)
+        chunks.append(chunk)
+
+    # Skip any trailers, up to the blank line ending the body
+    while True:
+        line = rfile.readline(MAX_CHUNK_LINE + 1)
+        if not line.strip():
+            return b''.join(chunks)
+
+
+class WebhookHubPayloadError(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
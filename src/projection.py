@@ -0,0 +1,172 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from src.builder import WebhookHubObjectTemplate, SymbolBuilder, TextBuilder, ObjectBuilder, ListBuilder, IfBuilder, ForBuilder, ConvertBuilder
+from src.parser import compile_template
+from src.template import SymbolNode, JSONSymbolNode, IfNode, ForNode
+
+
+__author__ = 'Evan Williams'
+
+
+# Stands for every key of a dictionary, or every item of a list, in a data path
+WILDCARD = '*'
+
+
+class DataPathNode:
+    __slots__ = ('children', 'whole', 'shape')
+
+    def __init__(self):
+        self.children = {}
+        # Whether all of the data is kept, or only its keys (or length) and whatever its children keep
+        self.whole = False
+        self.shape = False
+
+
+class WebhookHubPayloadProjection:
+    """
+    The parts of a payload a route can refer to, given by the data paths of its templates and expressions.
+    Projecting a decoded payload keeps only those parts, so the rest of a large payload is released right away
+    rather than kept for as long as the webhook event is being handled.
+
+    A path ending at some data (e.g. data.repository.full_name) keeps all of it, a loop key in a path (e.g. the i
+    of data.commits.i.message) stands for every key or item, and a reference to data itself keeps the whole payload.
+    Data that is only tested by an if-statement, iterated by a for-loop or measured with "length" keeps its keys
+    and items (those not otherwise referred to becoming None), so that its truthiness, keys and length are unchanged.
+    """
+
+    def __init__(self, paths):
+        self.root = DataPathNode()
+        self.size = 0
+        for path, shape in paths:
+            self.add_path(path, shape=shape)
+
+    def __str__(self):
+        return 'WebhookHubPayloadProjection({0} paths)'.format(self.size)
+
+    def add_path(self, path, shape=False):
+        node = self.root
+        for component in path:
+            if component == 'length':
+                # Either the length of a list, or a "length" key of a dictionary
+                node.children.setdefault(component, DataPathNode()).whole = True
+                shape = True
+                break
+            node = node.children.setdefault(component, DataPathNode())
+        if shape:
+            node.shape = True
+        else:
+            node.whole = True
+        self.size += 1
+
+    def project(self, payload):
+        """Get the parts of a payload referred to by the route, sharing (rather than copying) the data it keeps."""
+        return project_value(payload, [self.root])
+
+
+def project_value(value, nodes):
+    if any(node.whole for node in nodes):
+        return value
+
+    if type(value) == dict:
+        wildcards = [node.children[WILDCARD] for node in nodes if WILDCARD in node.children]
+        projected = {}
+        if wildcards or any(node.shape for node in nodes):
+            for key, item in value.items():
+                children = wildcards + [node.children[key] for node in nodes if key in node.children]
+                projected[key] = project_value(item, children) if children else None
+        else:
+            for node in nodes:
+                for key in node.children:
+                    if key in value and key not in projected:
+                        projected[key] = project_value(value[key], [node.children[key] for node in nodes if key in node.children])
+        return projected
+
+    if type(value) == list:
+        # Lists are indexed by position, so every item is kept (and projected) to keep their positions and the list's length
+        projected = []
+        for index, item in enumerate(value):
+            children = [node.children[key] for node in nodes for key in (WILDCARD, str(index)) if key in node.children]
+            projected.append(project_value(item, children) if children else None)
+        return projected
+
+    return value
+
+
+def collect_data_paths(texts=(), templates=()):
+    """
+    Collect the data paths referred to by some texts in the WebhookHub template syntax (e.g. expressions and config
+    variables) and by some compiled templates, as (tuple of components after "data", whether only its shape is used).
+    """
+    paths = []
+    for text in texts:
+        if text and '$' in text:
+            paths.extend(template_data_paths(compile_template(text).nodes, ()))
+    for template in templates:
+        if type(template) == WebhookHubObjectTemplate:
+            paths.extend(builder_data_paths(template.builder, ()))
+        else:
+            paths.extend(template_data_paths(template.nodes, ()))
+    return paths
+
+
+def template_data_paths(nodes, index_symbols):
+    for node in nodes:
+        if type(node) in [SymbolNode, JSONSymbolNode]:
+            yield from symbol_data_paths(node.symbol, index_symbols)
+        elif type(node) == IfNode:
+            yield from symbol_data_paths(node.symbol, index_symbols, shape=True)
+            yield from template_data_paths(node.body, index_symbols)
+            yield from template_data_paths(node.orelse, index_symbols)
+        elif type(node) == ForNode:
+            yield from symbol_data_paths(node.symbol, index_symbols, shape=True)
+            yield from template_data_paths(node.body, index_symbols + (node.index_symbol,))
+
+
+def builder_data_paths(builder, index_symbols):
+    if type(builder) == SymbolBuilder:
+        yield from symbol_data_paths(builder.symbol, index_symbols)
+    elif type(builder) == TextBuilder:
+        yield from template_data_paths(builder.template.nodes, index_symbols)
+    elif type(builder) == ObjectBuilder:
+        for key, value in builder.items:
+            yield from builder_data_paths(key, index_symbols)
+            yield from builder_data_paths(value, index_symbols)
+    elif type(builder) == ListBuilder:
+        for item in builder.items:
+            yield from builder_data_paths(item, index_symbols)
+    elif type(builder) == IfBuilder:
+        yield from symbol_data_paths(builder.symbol, index_symbols, shape=True)
+        for branch in (builder.then, builder.orelse):
+            if branch is not None:
+                yield from builder_data_paths(branch, index_symbols)
+    elif type(builder) == ForBuilder:
+        yield from symbol_data_paths(builder.symbol, index_symbols, shape=True)
+        yield from builder_data_paths(builder.each, index_symbols + (builder.index_symbol,))
+    elif type(builder) == ConvertBuilder:
+        yield from builder_data_paths(builder.value, index_symbols)
+
+
+def symbol_data_paths(symbol, index_symbols, shape=False):
+    components = symbol.split('.')
+    if components[0] != 'data':
+        return
+    # A loop key may select any key or item (it is also tried as a plain key, which the wildcard covers too)
+    yield (tuple(WILDCARD if component in index_symbols else component for component in components[1:]), shape)
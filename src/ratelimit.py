@@ -0,0 +1,174 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import email.utils
+import threading
+import time
+
+
+__author__ = 'Evan Williams'
+
+
+# Seconds after which a destination's whole limit is assumed to be available again, when it doesn't say
+DEFAULT_RESET_AFTER = 1.0
+
+
+class TokenBucket:
+    """
+    A token bucket holding up to capacity tokens, refilled at rate tokens per second.
+    A bucket without a capacity is unlimited until a destination reports its limits.
+    """
+
+    def __init__(self, capacity=None, rate=None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def refill(self, now):
+        if self.capacity is not None and self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now, max_wait=None):
+        """
+        Take a token, returning the seconds to wait until it may be used (0 if right away). Unless the wait is longer than
+        max_wait, the token is reserved meanwhile by letting the bucket go into debt, so that callers which wait are
+        spaced out by the rate rather than all proceeding at once when a token becomes available.
+        """
+        self.refill(now)
+
+        blocked = max(0.0, self.blocked_until - now)
+        if self.capacity is None:
+            return blocked
+        if self.tokens >= 1:
+            wait = blocked
+        elif not self.rate:
+            # Without a rate the debt would never be repaid, so nothing is reserved
+            return max(blocked, 1.0)
+        else:
+            wait = max(blocked, (1 - self.tokens) / self.rate)
+
+        if max_wait is not None and wait > max_wait:
+            return wait
+        self.tokens -= 1
+        return wait
+
+
+class WebhookHubRateLimiter:
+    """
+    Token buckets keyed by (evaluated) destination URL. Buckets start with the given rate, if any, and then follow
+    the X-RateLimit-* and Retry-After headers of each destination's responses (as sent by Discord and Slack).
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return 'WebhookHubRateLimiter(rate={0}, {1} destinations)'.format(self.rate, len(self.buckets))
+
+    def get_bucket(self, destination):
+        bucket = self.buckets.get(destination)
+        if bucket is None:
+            bucket = self.buckets[destination] = TokenBucket(capacity=self.rate, rate=self.rate)
+        return bucket
+
+    def acquire(self, destination, max_wait=None):
+        """
+        Take a token for a destination, returning the seconds to wait before using it (0 if right away).
+        If that is longer than max_wait, no token is taken and the caller should not deliver (see TokenBucket.take).
+        """
+        with self.lock:
+            return self.get_bucket(destination).take(time.monotonic(), max_wait=max_wait)
+
+    def update(self, destination, status_code, headers):
+        """
+        Update the bucket of a destination from the headers of one of its responses. A limit without a reset is assumed
+        to reset after DEFAULT_RESET_AFTER seconds, so that deliveries held for an exhausted bucket are eventually sent:
+
+        >>> limiter = WebhookHubRateLimiter()
+        >>> limiter.update('https://example.com/hook', 200, {'X-RateLimit-Limit': '5', 'X-RateLimit-Remaining': '0'})
+        >>> 0 < limiter.acquire('https://example.com/hook', max_wait=0) <= DEFAULT_RESET_AFTER / 5
+        True
+        >>> limiter.buckets['https://example.com/hook'].rate
+        5.0
+
+        """
+        limit = parse_number(headers.get('X-RateLimit-Limit'))
+        remaining = parse_number(headers.get('X-RateLimit-Remaining'))
+        reset_after = parse_number(headers.get('X-RateLimit-Reset-After'))
+        if reset_after is None and parse_number(headers.get('X-RateLimit-Reset')) is not None:
+            reset_after = max(0.0, parse_number(headers.get('X-RateLimit-Reset')) - time.time())
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.get_bucket(destination)
+            bucket.refill(now)
+
+            if limit is not None:
+                # Even a destination reporting no limit at all is tried once in a while
+                bucket.capacity = max(limit, 1.0)
+                if bucket.tokens is None:
+                    bucket.tokens = bucket.capacity
+                # The destination's whole limit becomes available again after the reset
+                if reset_after:
+                    bucket.rate = bucket.capacity / reset_after
+                elif not bucket.rate:
+                    bucket.rate = bucket.capacity / DEFAULT_RESET_AFTER
+            if remaining is not None and bucket.capacity is not None:
+                bucket.tokens = min(bucket.tokens, remaining)
+            if remaining == 0 and reset_after is not None:
+                bucket.blocked_until = max(bucket.blocked_until, now + reset_after)
+
+            if status_code == 429:
+                bucket.blocked_until = max(bucket.blocked_until, now + (retry_after if retry_after is not None else reset_after or 1.0))
+                if bucket.capacity is not None:
+                    bucket.tokens = 0
+
+
+def parse_number(value):
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def parse_retry_after(value):
+    """Get the seconds to wait from a Retry-After header, given either as a number of seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class WebhookHubRateLimitError(Exception):
+    def __init__(self, message, wait):
+        super().__init__(message)
+        self.wait = wait
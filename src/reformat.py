@@ -22,7 +22,8 @@ import json
 import re
 import sys
 
-from src.parser import WebhookHubParser
+from src.builder import WebhookHubObjectTemplate
+from src.parser import WebhookHubParserContext, WebhookHubParserError
 
 
 __author__ = 'Evan Williams'
@@ -31,18 +32,51 @@ __author__ = 'Evan Williams'
 INJECTION_PATTERN = re.compile(r'\${([\w\-]+)}')  # ${(variable)}
 
 
-def reformat_payload(payload, template_filepath, event_config):
-    evaluated_template = evaluate_template(payload, template_filepath, event_config)
+def render_payload(payload, template, event_config, context=None):
+    """
+    Render a compiled template for a payload into the body of a delivery: the objects built by a WebhookHubObjectTemplate,
+    or for a WebhookHubTemplate, a RenderedPayload if the template always renders valid JSON, which is then sent as is,
+    or otherwise the JSON deserialized from it (see reformat_payload).
+    """
+    if type(template) == WebhookHubObjectTemplate:
+        return build_payload(payload, template, event_config, context=context)
+    if not template.is_json():
+        return reformat_payload(payload, template, event_config, context=context)
+
+    if context is None:
+        context = WebhookHubParserContext(payload=payload, event_config=event_config)
+    rendered_template = context.render(template, as_json=True)
+    if rendered_template is None:
+        raise WebhookHubReformattingError('Unable to evaluate template', template.source)
+    return RenderedPayload(rendered_template)
+
+def build_payload(payload, template, event_config, context=None):
+    """Build the payload of a compiled WebhookHubObjectTemplate for a payload."""
+    if context is None:
+        context = WebhookHubParserContext(payload=payload, event_config=event_config)
+    try:
+        return template.build(context)
+    except WebhookHubParserError as e:
+        sys.stderr.write('Failed to build template: {0}\n'.format(e))
+        raise WebhookHubReformattingError('Unable to evaluate template', template.source)
+
+def reformat_payload(payload, template, event_config, context=None):
+    """
+    Render a compiled WebhookHubTemplate for a payload, and deserialize the result as JSON.
+    Renders of the same event can share a WebhookHubParserContext, so its config variables are only evaluated once.
+    """
+    evaluated_template = evaluate_template(payload, template, event_config, context=context)
+    if evaluated_template is None:
+        raise WebhookHubReformattingError('Unable to evaluate template', template.source)
     try:
         return json.loads(evaluated_template, strict=False)
     except json.decoder.JSONDecodeError:
         raise WebhookHubReformattingError('Unable to deserialize evaluated template', evaluated_template)
 
-def evaluate_template(payload, template_filepath, event_config):
-    with open(template_filepath, 'r') as fin:
-        template = fin.read()
-    # return re.sub(INJECTION_PATTERN, lambda x: evaluate_expression(event_config.get_variable(x.group(1)), payload) or x.group(0), template)
-    return evaluate_expression(template, payload, event_config)
+def evaluate_template(payload, template, event_config, context=None):
+    if context is None:
+        context = WebhookHubParserContext(payload=payload, event_config=event_config)
+    return context.render(template)
 
 def evaluate_expressions(expressions, payload, event_config):
     """
@@ -69,12 +103,19 @@ def evaluate_expression(expression, payload, event_config):
     if not expression:
         return None
 
-    parser = WebhookHubParser(payload=payload, event_config=event_config)
-    value = parser.parse(expression)
+    context = WebhookHubParserContext(payload=payload, event_config=event_config)
+    value = context.parse(expression)
 
     return value
 
 
+class RenderedPayload(str):
+    """A reformatted payload which is already JSON text, and is delivered without being serialized again."""
+
+    def decode(self):
+        return json.loads(self, strict=False)
+
+
 class WebhookHubReformattingError(Exception):
     def __init__(self, message, data):
         super().__init__(message)
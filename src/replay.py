@@ -0,0 +1,125 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import collections
+import requests
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from src.bench import percentile
+from src.delivery import HOP_BY_HOP_HEADERS
+
+
+__author__ = 'Evan Williams'
+
+
+DEFAULT_REPLAY_CONCURRENCY = 16
+DEFAULT_REPLAY_TIMEOUT = 30.0
+
+# Headers of a captured request which describe its original connection, and are set anew when it is replayed
+REPLACED_HEADERS = HOP_BY_HOP_HEADERS | {'host'}
+
+
+class WebhookHubReplayer:
+    """
+    Re-sends captured requests (see WebhookHubCaptureLog) to a server, keeping the intervals between them divided by
+    the given speed, or as fast as possible without one. Requests are sent by a pool of threads, so slow responses
+    don't hold back the schedule, with at most concurrency requests in flight at once.
+    """
+
+    def __init__(self, url, speed=1.0, concurrency=DEFAULT_REPLAY_CONCURRENCY, timeout=DEFAULT_REPLAY_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.speed = speed
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock = threading.Lock()
+        self.statuses = collections.Counter()
+        self.latencies = []
+        # Seconds by which the sending of each request was behind its schedule
+        self.max_lag = 0.0
+
+    def __str__(self):
+        return 'WebhookHubReplayer({0}, speed={1}, concurrency={2})'.format(self.url, self.speed or 'max', self.concurrency)
+
+    def replay(self, records):
+        """Replay captured requests in order, returning the seconds taken."""
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='webhookhub-replay')
+        in_flight = threading.BoundedSemaphore(self.concurrency)
+
+        start = time.monotonic()
+        first_time = None
+        for record in records:
+            if record.get('body') is None:
+                # The body of this request couldn't be read when it was captured
+                continue
+
+            if self.speed:
+                if first_time is None:
+                    first_time = record['time']
+                due = start + (record['time'] - first_time) / self.speed
+                now = time.monotonic()
+                if due > now:
+                    time.sleep(due - now)
+                else:
+                    self.max_lag = max(self.max_lag, now - due)
+
+            in_flight.acquire()
+            future = executor.submit(self.send, record)
+            future.add_done_callback(lambda _: in_flight.release())
+
+        executor.shutdown(wait=True)
+        self.session.close()
+        return time.monotonic() - start
+
+    def send(self, record):
+        headers = {name: value for name, value in record['headers'] if name.lower() not in REPLACED_HEADERS}
+        start = time.monotonic()
+        try:
+            response = self.session.request(record.get('method', 'POST'), self.url + record['path'], data=record['body'], headers=headers, timeout=self.timeout)
+            status = response.status_code
+        except requests.exceptions.Timeout:
+            status = 'timeout'
+        except requests.exceptions.RequestException:
+            status = 'error'
+        latency = time.monotonic() - start
+
+        with self.lock:
+            self.statuses[status] += 1
+            self.latencies.append(latency)
+
+    def summary(self, elapsed):
+        """Summarize the results of a replay which took the given seconds."""
+        latencies = sorted(self.latencies)
+        lines = ['Replayed {0} requests in {1:.2f} seconds ({2:.1f} requests/s), at most {3:.3f} seconds behind schedule'.format(
+            len(latencies), elapsed, len(latencies) / elapsed if elapsed else 0, self.max_lag)]
+        if latencies:
+            lines.append('Latency p50 {0:.3f} ms, p99 {1:.3f} ms'.format(percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+        lines.extend('{0}: {1}'.format(status, count) for status, count in sorted(self.statuses.items(), key=lambda item: str(item[0])))
+        return '\n'.join(lines)
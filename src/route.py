@@ -19,12 +19,17 @@
 # SOFTWARE.
 
 import configparser
+import re
+import types
+
+from src.expressions import WebhookHubExpressionCache
+from src.reformat import evaluate_expression
 
 
 __author__ = 'Evan Williams'
 
 
-RESERVED_KEYS = ['destination', 'template', 'parent']
+RESERVED_KEYS = ['destination', 'template', 'targets', 'parent']
 
 
 class WebhookHubRoute():
@@ -34,8 +39,28 @@ class WebhookHubRoute():
         self.agent = global_meta['agent']
         self.destination = global_meta.get('destination', None)
         self.template = global_meta.get('template', None)
+        self.targets = parse_targets(global_meta.get('targets', ''))
         self.key_from_header = global_meta.get('key-from-header', None)
         self.key_from_payload = global_meta.get('key-from-payload', None)
+        self.connect_timeout = global_meta.getfloat('connect-timeout', None)
+        self.read_timeout = global_meta.getfloat('read-timeout', None)
+        self.async_delivery = global_meta.getboolean('async-delivery', False)
+
+        # Path that requests can be sent to instead of being matched by their headers, e.g. /hooks/github/<event key>
+        self.path = global_meta.get('path', '/hooks/{0}'.format(re.sub(r'[^a-z0-9]+', '-', self.agent.lower()).strip('-')))
+
+        # Explicit matchers, which match requests as well as the agent does (see WebhookHubRouteMatcher)
+        self.priority = global_meta.getint('priority', 0)
+        self.match_path_prefixes = global_meta.get('match-path-prefix', '').split()
+        self.match_headers = [parse_header_matcher(line) for line in global_meta.get('match-header', '').splitlines() if line.strip()]
+        self.match_header_regexes = []
+        for line in global_meta.get('match-header-regex', '').splitlines():
+            if line.strip():
+                name, pattern = parse_header_matcher(line)
+                try:
+                    self.match_header_regexes.append((name, re.compile(pattern or '')))
+                except re.error as e:
+                    raise WebhookHubRouteError('invalid header regex "{0}" for route "{1}": {2}'.format(pattern, self.agent, e))
 
         self.configurations = {
             event_key: EventConfiguration(event_key, config[event_key]) for event_key in config.sections() if event_key != 'global-meta'
@@ -43,46 +68,63 @@ class WebhookHubRoute():
 
         # Set parents for all event configurations
         for event_key in self.configurations:
-            if 'parent' in config[event_key] and config[event_key]['parent'] in self.configurations:
+            if 'parent' in config[event_key]:
+                if config[event_key]['parent'] not in self.configurations:
+                    raise WebhookHubRouteError('event "{0}" of route "{1}" has unknown parent "{2}"'.format(event_key, self.agent, config[event_key]['parent']))
                 self.configurations[event_key].parent = self.configurations[config[event_key]['parent']]
             elif 'default' in self.configurations and event_key != 'default':
                 self.configurations[event_key].parent = self.configurations['default']
             else:
                 self.configurations[event_key].parent = None
 
+        # Resolve every event configuration once, so that lookups never have to walk the chain of parents
+        for event_key in self.configurations:
+            self.configurations[event_key].resolve(self)
+
+        self.default_configuration = self.configurations.get('default', None)
+        self.validate()
+
     def __str__(self):
         s = 'WebhookHubRoute({0})'.format(self.agent)
         for event_key in self.configurations:
             s += '\n- {0}'.format(str(self.configurations[event_key]))
         return s
 
+    def validate(self):
+        """Check that every event of this route resolves to a destination and a template for each of its targets."""
+        configurations = list(self.configurations.values()) or [None]
+        for configuration in configurations:
+            event_key = configuration.event_key if configuration is not None else 'default'
+            for destination, template in self.get_targets(event_key):
+                if not destination:
+                    raise WebhookHubRouteError('no valid destination for event "{0}" defined for route "{1}"'.format(event_key, self.agent))
+                if not template:
+                    raise WebhookHubRouteError('no valid template for event "{0}" defined for route "{1}"'.format(event_key, self.agent))
+
+    def get_targets(self, event_key):
+        """Get the (destination, template) pairs an event is delivered to, which is one pair unless "targets" are configured."""
+        configuration = self.get_event_configuration(event_key)
+        if configuration is not None:
+            return configuration.targets
+        return self.targets or ((self.destination, self.template),)
+
     def get_destination(self, event_key):
-        if event_key in self.configurations and self.configurations[event_key].get_destination():
-            return self.configurations[event_key].get_destination()
-        elif 'default' in self.configurations and self.configurations['default'].get_destination():
-            return self.configurations['default'].get_destination()
-        elif self.destination:
-            return self.destination
-        else:
-            raise WebhookHubRouteError('no valid destination for event "{0}" defined for route "{1}"'.format(event_key, self.agent))
+        configuration = self.get_event_configuration(event_key)
+        return configuration.destination if configuration is not None else self.destination
 
     def get_template(self, event_key):
-        if event_key in self.configurations and self.configurations[event_key].get_template():
-            return self.configurations[event_key].get_template()
-        elif 'default' in self.configurations and self.configurations['default'].get_template():
-            return self.configurations['default'].get_template()
-        elif self.template:
-            return self.template
-        else:
-            raise WebhookHubRouteError('no valid template for event "{0}" defined for route "{1}"'.format(event_key, self.agent))
+        configuration = self.get_event_configuration(event_key)
+        return configuration.template if configuration is not None else self.template
 
     def get_event_configuration(self, event_key):
-        if event_key in self.configurations:
-            return self.configurations[event_key]
-        elif 'default' in self.configurations:
-            return self.configurations['default']
-        else:
-            return None
+        return self.configurations.get(event_key, self.default_configuration)
+
+    def get_event_key(self, headers, payload):
+        """Get the event key of a webhook event from its headers, falling back to its payload, or None if it has neither."""
+        if self.key_from_header and self.key_from_header in headers:
+            return headers[self.key_from_header]
+        elif self.key_from_payload:
+            return evaluate_expression(self.key_from_payload, payload, None)
 
     @staticmethod
     def from_file(filepath):
@@ -92,40 +134,89 @@ class WebhookHubRoute():
             
 
 class EventConfiguration():
+    """
+    The configuration of one event of a route. Once resolved, its variables, destination, template and targets include
+    those inherited from its parents (and, for all but its variables, from the route's [global-meta]).
+
+    Targets, if configured, override the destination and template. Each line of "targets" is a destination and the
+    name of the template to deliver it, so an event can be delivered to several destinations, each in its own format.
+    """
+
     def __init__(self, event_key, config):
         self.event_key = event_key
         self.parent = None
-        self.destination = config.get('destination', None)
-        self.template = config.get('template', None)
-
-        self.variables = {key.lower(): config[key] for key in config if key.lower() not in RESERVED_KEYS}
+        self.resolved = False
+        self.own_destination = config.get('destination', None)
+        self.own_template = config.get('template', None)
+        self.own_targets = parse_targets(config.get('targets', ''))
+        self.own_variables = {key.lower(): config[key] for key in config if key.lower() not in RESERVED_KEYS}
+
+        self.destination = None
+        self.template = None
+        self.configured_targets = ()
+        self.targets = ()
+        self.variables = types.MappingProxyType(self.own_variables)
+        self.expression_cache = None
 
     def __str__(self):
-        return 'EventConfiguration({0}, {1} variables{2})'.format(self.event_key, len(self.variables), ', parent={0}'.format(self.parent.event_key) if self.parent else '')
+        return 'EventConfiguration({0}, {1} variables{2})'.format(self.event_key, len(self.own_variables), ', parent={0}'.format(self.parent.event_key) if self.parent else '')
+
+    def resolve(self, route, resolving=()):
+        """Flatten the inherited variables, destination and template of this configuration, raising if its parents form a cycle."""
+        if self.resolved:
+            return
+        if self.event_key in resolving:
+            cycle = resolving[resolving.index(self.event_key):] + (self.event_key,)
+            raise WebhookHubRouteError('event "{0}" of route "{1}" inherits from itself: {2}'.format(self.event_key, route.agent, ' -> '.join(cycle)))
+
+        if self.parent is not None:
+            self.parent.resolve(route, resolving + (self.event_key,))
+            variables = dict(self.parent.variables)
+            variables.update(self.own_variables)
+            self.variables = types.MappingProxyType(variables)
+            self.destination = self.own_destination or self.parent.destination
+            self.template = self.own_template or self.parent.template
+            self.configured_targets = self.own_targets or self.parent.configured_targets
+        else:
+            self.destination = self.own_destination or route.destination
+            self.template = self.own_template or route.template
+            self.configured_targets = self.own_targets or route.targets
+
+        self.targets = self.configured_targets or ((self.destination, self.template),)
+        self.expression_cache = WebhookHubExpressionCache(self.variables)
+
+        self.resolved = True
 
     def get_variable(self, name):
-        if name.lower() in self.variables:
-            return self.variables[name.lower()]
-        elif self.parent is not None:
-            return self.parent.get_variable(name)
-        else:
-            return None
+        value = self.variables.get(name, None)
+        if value is None and not name.islower():
+            value = self.variables.get(name.lower(), None)
+        return value
 
     def get_destination(self):
-        if self.destination:
-            return self.destination
-        elif self.parent is not None:
-            return self.parent.get_destination()
-        else:
-            return None
+        return self.destination
 
     def get_template(self):
-        if self.template:
-            return self.template
-        elif self.parent is not None:
-            return self.parent.get_template()
-        else:
-            return None
+        return self.template
+
+
+def parse_targets(text):
+    """Parse lines of "<destination> <template>" targets into a tuple of (destination, template) pairs."""
+    targets = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        target = line.split()
+        if len(target) != 2:
+            raise WebhookHubRouteError('invalid target "{0}", expected a destination and a template'.format(line.strip()))
+        targets.append(tuple(target))
+    return tuple(targets)
+
+
+def parse_header_matcher(line):
+    """Split a "Header-Name: value" matcher into its lowercased header name and value (None if only a name is given)."""
+    name, separator, value = line.partition(':')
+    return (name.strip().lower(), value.strip() if separator else None)
 
 
 class WebhookHubRouteError(Exception):
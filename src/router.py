@@ -0,0 +1,78 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+
+from urllib.parse import unquote
+
+
+__author__ = 'Evan Williams'
+
+
+class PathNode:
+    __slots__ = ('children', 'route')
+
+    def __init__(self):
+        self.children = {}
+        self.route = None
+
+
+class WebhookHubPathRouter:
+    """
+    Routes requests by their path, using a prefix tree of the routes' paths (see WebhookHubRoute.path).
+
+    A request to a route's path, e.g. /hooks/github, is routed to that route, and one to a path below it,
+    e.g. /hooks/github/push, is also given the rest of its path as its event key.
+    """
+
+    def __init__(self, routes):
+        self.root = PathNode()
+
+        for route in routes:
+            node = self.root
+            for segment in split_path(route.path):
+                node = node.children.setdefault(segment, PathNode())
+            if node.route is not None:
+                sys.stderr.write('Route "{0}" has the same path as route "{1}": {2}\n'.format(route.agent, node.route.agent, route.path))
+                continue
+            node.route = route
+
+    def match(self, path):
+        """Get the route for a request path and the event key it names (or None), or (None, None) if it has no route."""
+        segments = split_path(path)
+        route = None
+        event_segments = []
+
+        node = self.root
+        for i, segment in enumerate(segments):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.route is not None:
+                route = node.route
+                event_segments = segments[i + 1:]
+
+        if route is None:
+            return (None, None)
+        return (route, '/'.join(event_segments) or None)
+
+
+def split_path(path):
+    return [unquote(segment) for segment in path.split('?', 1)[0].split('/') if segment]
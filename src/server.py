@@ -18,73 +18,180 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
 import json
-import os
 import requests
 import sys
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler
 
-from src.reformat import reformat_payload, evaluate_expression, WebhookHubReformattingError
+from src.delivery import DEFAULT_FANOUT_WORKERS, WebhookHubDelivery, WebhookHubDeliveryClient, WebhookHubDeliveryQueue, relayed_headers
+from src.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, WebhookHubMetrics
+from src.parser import WebhookHubParserContext
+from src.payload import DEFAULT_MAX_PAYLOAD_SIZE, WebhookHubPayloadError, decode_payload, read_body
+from src.ratelimit import WebhookHubRateLimitError
+from src.reformat import render_payload, WebhookHubReformattingError
 from src.route import WebhookHubRouteError
+from src.tracing import stage
 
 
 __author__ = 'Evan Williams'
 
 
-def make_WebhookHubRequestHandler_class(routes, templates_dir, debug=False):
-    def debug_log(text):
+def make_WebhookHubRequestHandler_class(cache, delivery_client=None, delivery_queue=None, rate_limiter=None, fanout_workers=DEFAULT_FANOUT_WORKERS,
+        max_payload_size=DEFAULT_MAX_PAYLOAD_SIZE, metrics=None, tracer=None, capture_log=None,
+        project_payloads=False, debug=False):
+    if delivery_client is None:
+        delivery_client = WebhookHubDeliveryClient()
+    if delivery_queue is None:
+        delivery_queue = WebhookHubDeliveryQueue(delivery_client, debug=debug)
+
+    # Delivers to all but the first target of an event at once (the request's own thread delivers to the first)
+    fanout_executor = ThreadPoolExecutor(max_workers=fanout_workers, thread_name_prefix='webhookhub-fanout')
+
+    def debug_log(text, *args):
+        # Only format the text when it's printed, as its arguments may be whole payloads
         if debug:
-            print(text)
+            print(text.format(*args) if args else text)
+
+    path_hits_lock = threading.Lock()
+
+    # Labeled by route agent and by the event configuration used (not the event key as given, which is unbounded)
+    if metrics is None:
+        metrics = WebhookHubMetrics()
+    metrics.counter('webhookhub_requests_total', 'Webhook events received, by response status.', labels=('route', 'event', 'status'))
+    metrics.histogram('webhookhub_request_duration_seconds', 'Time taken to handle webhook events, from reading to responding.', labels=('route', 'event'))
+    metrics.histogram('webhookhub_render_duration_seconds', 'Time taken to render the payload of a webhook event for one of its targets.', labels=('route', 'event'))
+    metrics.histogram('webhookhub_delivery_duration_seconds', 'Time taken by destinations to respond to webhook events delivered while their origin waits.', labels=('route', 'event'))
+    metrics.counter('webhookhub_destination_responses_total', 'Responses of destinations to webhook events delivered while their origin waits, by status.', labels=('route', 'event', 'status'))
+    metrics.gauge('webhookhub_delivery_queue_size', 'Webhook events waiting in the queue for delivery.', delivery_queue.size)
 
     class WebhookHubRequestHandler(BaseHTTPRequestHandler):
+        # Number of requests routed by their path, by route path and (configured) event key, e.g. /hooks/github/push
+        path_hits = collections.Counter()
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.error_response(404, b'Not found')
+                return
+            self.error_response(200, metrics.expose().encode('utf-8'), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
         def do_POST(self):
-            debug_log('new POST request, headers:\n{0}'.format(str(self.headers)))
+            arrival = time.time()
+            start = time.perf_counter()
+            self.status = None
+            self.labels = ('', '')
+            self.body = None
+            self.trace = tracer.start_trace(self.path) if tracer else None
+            try:
+                self.handle_event()
+            finally:
+                duration = time.perf_counter() - start
+                # Requests which failed without a response (i.e. unhandled errors) have no status
+                metrics.increment('webhookhub_requests_total', self.labels + (str(self.status or ''),))
+                metrics.observe('webhookhub_request_duration_seconds', self.labels, duration)
+                if capture_log:
+                    capture_log.record(arrival, duration, self.status, self.command, self.path, list(self.headers.items()), self.body)
+                if self.trace is not None:
+                    self.trace.route, self.trace.event = (label or None for label in self.labels)
+                    self.trace.status = self.status
+                    tracer.finish_trace(self.trace)
+
+        def handle_event(self):
+            debug_log('new POST request, headers:\n{0}', self.headers)
 
             try:
                 debug_log('read payload...')
-                self.read_payload()
-                debug_log(str(self.payload))
+                with stage(self.trace, 'read_payload'):
+                    self.read_payload()
+                debug_log('{0}', self.payload)
 
-                route = self.get_route()
+                # Routes may be reloaded meanwhile, so the whole request is handled with the routes it started with
+                snapshot = cache.snapshot
+                with stage(self.trace, 'get_route'):
+                    route, event_key = self.get_route(snapshot)
                 if not route:
                     debug_log('invalid user agent')
                     self.error_response(403, b'No compatible route is defined for this User-Agent')
                     return
-                debug_log('webhook route = {0}'.format(route.agent))
+                debug_log('webhook route = {0}', route.agent)
+                self.labels = (route.agent, '')
+
+                # Only keep the parts of the payload the route refers to, releasing the rest
+                if project_payloads:
+                    with stage(self.trace, 'project'):
+                        projection = cache.get_projection(snapshot, route)
+                        if projection is not None:
+                            self.payload = projection.project(self.payload)
 
-                event_key = self.get_event_key(route)
+                if not event_key:
+                    with stage(self.trace, 'get_event_key'):
+                        event_key = route.get_event_key(self.headers, self.payload)
                 if not event_key:
                     self.error_response(400, b'Unable to determine the event key for this webhook event')
                     return
-                debug_log('webhook event key = {0}'.format(event_key))
+                debug_log('webhook event key = {0}', event_key)
 
                 event_config = route.get_event_configuration(event_key)
                 if not event_config:
                     self.error_response(400, b'No compatible event configuration for this webhook event')
                     return
+                self.labels = (route.agent, event_config.event_key)
+
+                # Every target is rendered with the same context, so shared config variables are only evaluated once
+                context = WebhookHubParserContext(payload=self.payload, event_config=event_config)
+                targets = route.get_targets(event_key)
+                deliveries = []
+                for destination, template_name in targets:
+                    render_start = time.perf_counter()
+                    with stage(self.trace, 'evaluate_destination'):
+                        destination = context.parse(destination)
+                    template = cache.get_template(template_name)
 
-                destination = evaluate_expression(route.get_destination(event_key), self.payload, event_config)
-                template = os.path.join(templates_dir, route.get_template(event_key))
+                    debug_log('reformat payload with template {0}...', template_name)
+                    with stage(self.trace, 'reformat_payload'):
+                        reformatted_payload = render_payload(self.payload, template, event_config, context=context)
+                    metrics.observe('webhookhub_render_duration_seconds', self.labels, time.perf_counter() - render_start)
+                    debug_log('reformatted payload={0}', reformatted_payload)
 
-                debug_log('reformat payload...')
-                reformatted_payload = reformat_payload(self.payload, template, event_config)
-                debug_log('reformatted payload={0}'.format(reformatted_payload))
+                    deliveries.append(WebhookHubDelivery(destination, reformatted_payload, route.connect_timeout, route.read_timeout))
 
-                debug_log('routing webhook event to {0}'.format(destination))
-                headers = {
-                    'Content-Type': 'application/json'
-                }
-                response = requests.post(destination, json=reformatted_payload, headers=headers)
+                if route.async_delivery:
+                    with stage(self.trace, 'queue'):
+                        queued = delivery_queue.put_all(deliveries)
+                    if not queued:
+                        self.error_response(503, b'Too many webhook events are waiting to be delivered')
+                        return
+                    # Once some deliveries are queued, the event is accepted, since sending it again would duplicate them
+                    if queued < len(deliveries):
+                        sys.stderr.write('Dropped {0} of {1} deliveries of a webhook event, as the delivery queue is full\n'.format(len(deliveries) - queued, len(deliveries)))
+                    debug_log('queued webhook event for delivery to {0} of {1} targets', queued, len(deliveries))
+                    self.error_response(202, b'Accepted for delivery')
+                    return
+
+                if len(deliveries) > 1:
+                    with stage(self.trace, 'deliver'):
+                        self.fan_out([template_name for _, template_name in targets], deliveries)
+                    return
+
+                with stage(self.trace, 'deliver'):
+                    response = self.deliver(deliveries[0])
 
                 debug_log('responding to origin...')
 
                 self.send_response(response.status_code)
-                for key, header in response.headers.items():
+                for key, header in relayed_headers(response):
                     self.send_header(key, header)
+                self.send_header('Content-Length', len(response.content))
                 self.end_headers()
                 self.wfile.write(response.content)
 
+            except WebhookHubRateLimitError as e:
+                self.error_response(429, bytes(str(e), 'utf-8'), headers={'Retry-After': str(int(e.wait) + 1)})
+
             except WebhookHubRouteError as e:
                 sys.stderr.write('{0}\n'.format(e))
                 self.error_response(400, bytes(str(e), 'utf-8'))
@@ -94,42 +201,112 @@ def make_WebhookHubRequestHandler_class(routes, templates_dir, debug=False):
                 sys.stderr.write('{0}\n'.format(e.data))
                 self.error_response(400, bytes(str(e), 'utf-8'))
 
+            except WebhookHubPayloadError as e:
+                debug_log('unable to read payload: {0}', e)
+                # The rest of a rejected body is left unread, so the connection can't be reused
+                self.close_connection = True
+                self.error_response(e.status, bytes(str(e), 'utf-8'), headers={'Connection': 'close'})
+
             except json.decoder.JSONDecodeError:
                 debug_log('unable to read payload')
                 self.error_response(400, b'Unable to read webhook event payload')
 
+            except requests.exceptions.Timeout as e:
+                sys.stderr.write('{0}\n'.format(e))
+                self.error_response(504, b'Timed out delivering webhook event to its destination')
+
+            except requests.exceptions.RequestException as e:
+                sys.stderr.write('{0}\n'.format(e))
+                self.error_response(502, b'Unable to deliver webhook event to its destination')
+
+        def deliver(self, delivery):
+            """Deliver a webhook event to its destination once it isn't rate limited, returning the destination's response."""
+            if rate_limiter:
+                max_wait = delivery.read_timeout or delivery_client.read_timeout
+                wait = rate_limiter.acquire(delivery.destination, max_wait=max_wait)
+                if wait > max_wait:
+                    raise WebhookHubRateLimitError('The destination of this webhook event is rate limited', wait)
+                elif wait > 0:
+                    debug_log('waiting {0:.2f} seconds for rate limited destination', wait)
+                    time.sleep(wait)
+
+            debug_log('routing webhook event to {0}', delivery.destination)
+            start = time.perf_counter()
+            try:
+                response = delivery_client.post(delivery.destination, delivery.payload, connect_timeout=delivery.connect_timeout, read_timeout=delivery.read_timeout)
+            except requests.exceptions.RequestException as e:
+                metrics.increment('webhookhub_destination_responses_total', self.labels + ('timeout' if isinstance(e, requests.exceptions.Timeout) else 'error',))
+                raise
+            finally:
+                metrics.observe('webhookhub_delivery_duration_seconds', self.labels, time.perf_counter() - start)
+            metrics.increment('webhookhub_destination_responses_total', self.labels + (str(response.status_code),))
+            if rate_limiter:
+                rate_limiter.update(delivery.destination, response.status_code, response.headers)
+            return response
+
+        def deliver_target(self, index, template_name, delivery):
+            """Deliver a webhook event to one of its targets, returning the outcome (destinations are left out, as their URLs may hold secrets)."""
+            outcome = {'target': index, 'template': template_name}
+            try:
+                return dict(outcome, status=self.deliver(delivery).status_code)
+            except WebhookHubRateLimitError as e:
+                return dict(outcome, status=429, error=str(e))
+            except requests.exceptions.Timeout as e:
+                sys.stderr.write('{0}\n'.format(e))
+                return dict(outcome, status=504, error='Timed out delivering webhook event to its destination')
+            except requests.exceptions.RequestException as e:
+                sys.stderr.write('{0}\n'.format(e))
+                return dict(outcome, status=502, error='Unable to deliver webhook event to its destination')
+            except Exception as e:
+                # Any other failure only fails its own target, so the origin still gets the outcome of every target
+                sys.stderr.write('Failed to deliver webhook event to target {0}: {1}: {2}\n'.format(index, type(e).__name__, e))
+                return dict(outcome, status=500, error='Unable to deliver webhook event to its destination')
+
+        def fan_out(self, template_names, deliveries):
+            """
+            Deliver a webhook event to several targets at once, and respond with the outcome of each:
+            200 if every delivery succeeded, 207 if only some did, or 502 if none did.
+            """
+            futures = [fanout_executor.submit(self.deliver_target, index, template_names[index], deliveries[index]) for index in range(1, len(deliveries))]
+            outcomes = [self.deliver_target(0, template_names[0], deliveries[0])] + [future.result() for future in futures]
+
+            succeeded = sum(1 for outcome in outcomes if 200 <= outcome['status'] < 300)
+            status = 200 if succeeded == len(outcomes) else (207 if succeeded else 502)
+            debug_log('delivered webhook event to {0} of {1} targets', succeeded, len(outcomes))
+
+            self.error_response(status, bytes(json.dumps({'targets': outcomes}), 'utf-8'), headers={'Content-Type': 'application/json'})
+
         def read_payload(self):
-            if 'Content-Length' in self.headers:
-                self.payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
-            else:
-                self.payload = json.loads(self.rfile.read().decode('utf-8'))
-
-        def get_route(self):
-            # Look for any known agent that is a substring of the User-Agent header
-            if 'User-Agent' in self.headers:
-                user_agent_header = self.headers['User-Agent'].lower()
-                for agent in routes:
-                    if agent.lower() in user_agent_header:
-                        return routes[agent]
-            # If no user agent, look for a match in any of the sent header keys
-            else:
-                for agent in routes:
-                    for header_key in self.headers:
-                        if agent.lower() in header_key.lower():
-                            return routes[agent]
-
-            return None
-
-        def get_event_key(self, route):
-            if route.key_from_header and route.key_from_header in self.headers:
-                return self.headers[route.key_from_header]
-            elif route.key_from_payload:
-                return evaluate_expression(route.key_from_payload, self.payload, self)
-
-        def error_response(self, status, bytes_data):
+            # The payload is decoded straight from the body's bytes, which are then released, or kept until the request is captured
+            body = read_body(self.rfile, self.headers, max_size=max_payload_size)
+            if capture_log:
+                self.body = body
+            self.payload = decode_payload(body)
+
+        def get_route(self, snapshot):
+            """Get the route of this request and the event key given by its path, if any (see WebhookHubRouteSnapshot.match_route)."""
+            route, event_key, routed_path = snapshot.match_route(self.path, self.headers)
+            if routed_path is not None:
+                with path_hits_lock:
+                    self.path_hits[routed_path] += 1
+            return (route, event_key)
+
+        def send_response(self, code, message=None):
+            self.status = code
+            super().send_response(code, message)
+
+        def error_response(self, status, bytes_data, headers={}):
             self.send_response(status)
+            for key, header in headers.items():
+                self.send_header(key, header)
             self.send_header('Content-Length', len(bytes_data))
             self.end_headers()
             self.wfile.write(bytes_data)
 
+    def collect_path_hits():
+        with path_hits_lock:
+            return {(path,): hits for path, hits in WebhookHubRequestHandler.path_hits.items()}
+
+    metrics.collected_counter('webhookhub_path_hits_total', 'Webhook events routed by their path, by route path and event key.', collect_path_hits, labels=('path',))
+
     return WebhookHubRequestHandler
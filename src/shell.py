@@ -20,7 +20,7 @@
 
 import sys
 
-from src.parser import WebhookHubParser
+from src.parser import WebhookHubParserContext
 
 
 __author__ = 'Evan Williams'
@@ -34,13 +34,14 @@ def start_shell(opening_text, payload):
 
     print('Use "exit" or Ctrl-D (i.e. EOF) to exit')
 
+    context = WebhookHubParserContext(payload=payload)
+
     while True:
         try:
             input_text = input('> ')
             if input_text == 'exit':
                 sys.exit(0)
-            parser = WebhookHubParser(payload=payload)
-            result = parser.parse(input_text)
+            result = context.parse(input_text)
         except SyntaxError as e:
             sys.stderr.write('Failed to parse text: {0}\n'.format(e))
             result = ''
@@ -0,0 +1,283 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import re
+
+from collections import namedtuple
+
+
+__author__ = 'Evan Williams'
+
+
+# Maximum number of ways (combinations of if-branches and for-loop iterations) to render a template when
+# checking that it always renders valid JSON; more complex templates are simply not rendered as JSON directly
+MAX_JSON_VARIANTS = 256
+
+# Stands in for the value of every symbol when checking a template, which is only valid JSON inside a string
+JSON_SYMBOL_MARKER = '\ue000'
+
+CONTROL_CHARACTER_PATTERN = re.compile(r'[\x00-\x1f]')
+
+
+# Render plan nodes. Every node is an immutable tuple exposing render(context, index_context),
+# where the context is whatever object evaluates symbols for the current payload (see WebhookHubParserContext).
+
+class TextNode(namedtuple('TextNode', ['text'])):
+    __slots__ = ()
+
+    def render(self, context, index_context):
+        return self.text
+
+
+class SymbolNode(namedtuple('SymbolNode', ['symbol'])):
+    __slots__ = ()
+
+    def render(self, context, index_context):
+        return str(context.evaluate_symbol(self.symbol, index_context=index_context, stringify=True))
+
+
+class JSONSymbolNode(namedtuple('JSONSymbolNode', ['symbol', 'escape'])):
+    """A symbol known to be inside a JSON string, whose value is escaped (unless it already is) so that it stays one."""
+    __slots__ = ()
+
+    def render(self, context, index_context):
+        value = str(context.evaluate_symbol(self.symbol, index_context=index_context, stringify=True))
+        return self.escape(value) if self.escape else value
+
+
+class IfNode(namedtuple('IfNode', ['symbol', 'negate', 'body', 'orelse'])):
+    __slots__ = ()
+
+    def render(self, context, index_context):
+        condition = bool(context.evaluate_symbol(self.symbol, index_context=index_context))
+        if condition != self.negate:
+            return render_nodes(self.body, context, index_context)
+        return render_nodes(self.orelse, context, index_context)
+
+
+class ForNode(namedtuple('ForNode', ['index_symbol', 'symbol', 'body'])):
+    __slots__ = ()
+
+    def render(self, context, index_context):
+        # The iterated symbol may itself use the keys of enclosing for-loops (e.g. data.z.i)
+        indexes = context.get_indexes(self.symbol, index_context=index_context)
+
+        # Each iteration pushes its key into the shared index context rather than copying it,
+        # which is safe since a compiled template never reuses the key of an enclosing for-loop
+        chunks = []
+        try:
+            for index in indexes:
+                index_context[self.index_symbol] = index
+                chunks.append(render_nodes(self.body, context, index_context))
+        finally:
+            index_context.pop(self.index_symbol, None)
+        return ''.join(chunks)
+
+
+def merge_text_nodes(nodes):
+    """Merge adjacent text nodes (e.g. text around an escaped character) so each is rendered as one string."""
+    merged = []
+    for node in nodes:
+        if type(node) == IfNode:
+            node = node._replace(body=merge_text_nodes(node.body), orelse=merge_text_nodes(node.orelse))
+        elif type(node) == ForNode:
+            node = node._replace(body=merge_text_nodes(node.body))
+
+        if type(node) == TextNode and merged and type(merged[-1]) == TextNode:
+            merged[-1] = TextNode(merged[-1].text + node.text)
+        else:
+            merged.append(node)
+    return tuple(merged)
+
+
+def to_json_nodes(nodes):
+    """
+    Get the nodes of a template which renders valid JSON for any payload (see check_json_nodes) with every symbol
+    escaped for the JSON string it is in, or None if the template can't be shown to render valid JSON.
+    """
+    if not check_json_nodes(nodes):
+        return None
+    return escape_json_symbols(nodes)
+
+
+def check_json_nodes(nodes):
+    """
+    Check that every way of rendering some nodes is valid JSON in which symbols only appear inside strings,
+    trying both branches of every if-block and zero, one and two iterations of every for-loop.
+    """
+    variants = render_variants(nodes, MAX_JSON_VARIANTS)
+    if variants is None:
+        return False
+
+    for variant in variants:
+        try:
+            json.loads(variant)
+        except ValueError:
+            return False
+    return True
+
+
+def render_variants(nodes, limit):
+    """Get the distinct ways of rendering some nodes, or None as soon as there turn out to be more than limit of them."""
+    variants = {''}
+    for node in nodes:
+        endings = node_variants(node, limit)
+        if endings is None:
+            return None
+
+        extended = set()
+        for variant in variants:
+            for ending in endings:
+                extended.add(variant + ending)
+                if len(extended) > limit:
+                    return None
+        variants = extended
+    return variants
+
+
+def node_variants(node, limit):
+    if type(node) == TextNode:
+        return {node.text}
+    elif type(node) == SymbolNode:
+        return {JSON_SYMBOL_MARKER}
+    elif type(node) == IfNode:
+        body = render_variants(node.body, limit)
+        orelse = render_variants(node.orelse, limit) if body is not None else None
+        if orelse is None or len(body | orelse) > limit:
+            return None
+        return body | orelse
+    elif type(node) == ForNode:
+        bodies = render_variants(node.body, limit)
+        if bodies is None or 2 * len(bodies) + 1 > limit:
+            return None
+        return {''} | bodies | {body + body for body in bodies}
+    raise TypeError('unknown template node {0}'.format(node))
+
+
+def escape_json_symbols(nodes):
+    escaped = []
+    for node in nodes:
+        if type(node) == SymbolNode:
+            node = JSONSymbolNode(node.symbol, json_symbol_escape(node.symbol))
+        elif type(node) == IfNode:
+            node = node._replace(body=escape_json_symbols(node.body), orelse=escape_json_symbols(node.orelse))
+        elif type(node) == ForNode:
+            node = node._replace(body=escape_json_symbols(node.body))
+        escaped.append(node)
+    return tuple(escaped)
+
+
+def to_string_nodes(nodes):
+    """
+    Get the nodes of a template rendered inside a JSON string, such as a config variable inserted into a JSON template,
+    with its text and every symbol escaped for the string (see escape_string_text).
+    """
+    escaped = []
+    for node in nodes:
+        if type(node) == TextNode:
+            node = TextNode(escape_string_text(node.text))
+        elif type(node) == SymbolNode:
+            node = JSONSymbolNode(node.symbol, json_symbol_escape(node.symbol))
+        elif type(node) == IfNode:
+            node = node._replace(body=to_string_nodes(node.body), orelse=to_string_nodes(node.orelse))
+        elif type(node) == ForNode:
+            node = node._replace(body=to_string_nodes(node.body))
+        escaped.append(node)
+    return tuple(escaped)
+
+
+def json_symbol_escape(symbol):
+    """Get the function escaping a symbol's (stringified) value for a JSON string, or None if it needs none."""
+    first_component = symbol.split('.')[0]
+    if first_component == 'data':
+        return None
+    elif first_component == 'config':
+        # Config values are rendered as JSON strings themselves when rendering JSON (see WebhookHubTemplate.render_string)
+        return None
+    return escape_json_string
+
+
+def escape_string_text(text):
+    """
+    Escape the text of a template for a JSON string. Text which already is the inside of a JSON string (but for control
+    characters) keeps the meaning it has when a rendered template is deserialized, and any other text is taken literally.
+    """
+    try:
+        json.loads('"{0}"'.format(text), strict=False)
+    except ValueError:
+        return escape_json_string(text)
+    return escape_control_characters(text)
+
+
+def escape_control_characters(value):
+    if not CONTROL_CHARACTER_PATTERN.search(value):
+        return value
+    return CONTROL_CHARACTER_PATTERN.sub(lambda match: json.dumps(match.group(0))[1:-1], value)
+
+
+def escape_json_string(value):
+    return json.dumps(value)[1:-1]
+
+
+def render_nodes(nodes, context, index_context):
+    return ''.join([node.render(context, index_context) for node in nodes])
+
+
+class WebhookHubTemplate:
+    """
+    An immutable render plan compiled from text written in the WebhookHub template syntax.
+    Templates are compiled once (see parser.compile_template) and rendered for every payload.
+
+    Templates which always render valid JSON, with their symbols only inside strings, can also be rendered
+    with render_json() straight into a request body, without deserializing and serializing it again.
+    The config variables they refer to are then rendered with render_string(), so their values are escaped too.
+    """
+
+    __slots__ = ('source', 'nodes', 'json_nodes', 'string_nodes')
+
+    def __init__(self, source, nodes):
+        self.source = source
+        self.nodes = tuple(nodes)
+        self.json_nodes = to_json_nodes(self.nodes)
+        # Only config variables are rendered as strings, so their plan is made on first use
+        self.string_nodes = None
+
+    def __str__(self):
+        return 'WebhookHubTemplate({0} nodes)'.format(len(self.nodes))
+
+    def render(self, context):
+        """Render this template, evaluating symbols with the given context (e.g. a WebhookHubParserContext)."""
+        return render_nodes(self.nodes, context, {})
+
+    def is_json(self):
+        return self.json_nodes is not None
+
+    def render_json(self, context):
+        """Render this template as JSON text, escaping every symbol for the JSON string it is in."""
+        if self.json_nodes is None:
+            raise ValueError('template does not always render valid JSON')
+        return render_nodes(self.json_nodes, context, {})
+
+    def render_string(self, context):
+        """Render this template as the inside of a JSON string, escaping its text and every symbol for it."""
+        if self.string_nodes is None:
+            self.string_nodes = to_string_nodes(self.nodes)
+        return render_nodes(self.string_nodes, context, {})
@@ -0,0 +1,256 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import contextlib
+import cProfile
+import heapq
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+
+from collections import Counter
+
+
+__author__ = 'Evan Williams'
+
+
+# Traces (and profiles) which may wait to be written before new ones are dropped, so a slow disk never holds up requests
+DEFAULT_MAX_PENDING = 10000
+
+PROFILE_SUFFIX = '.prof'
+
+# Stage used when there is no trace, as a reusable context manager doing nothing
+NULL_STAGE = contextlib.nullcontext()
+
+# The trace of the request being handled by each thread, if it is sampled
+local = threading.local()
+
+
+def stage(trace, name):
+    """Time a stage of a request with its trace, if it has one: `with stage(trace, 'render'): ...`"""
+    return trace.stage(name) if trace is not None else NULL_STAGE
+
+
+def count(name, amount=1):
+    """Add to a count of the trace of the request being handled by this thread, if it is sampled."""
+    trace = getattr(local, 'trace', None)
+    if trace is not None:
+        trace.counts[name] += amount
+
+
+class WebhookHubTrace:
+    """The time taken by each stage of handling a request, and counts of the work done by the parser while handling it."""
+
+    def __init__(self, path):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+
+        self.route = None
+        self.event = None
+        self.status = None
+
+        # Seconds spent in each stage (summed, for stages run once per target) and counts, in the order they happened
+        self.stages = {}
+        self.counts = Counter()
+        self.profile = None
+
+    def __str__(self):
+        return 'WebhookHubTrace({0}, {1})'.format(self.id, self.path)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def activate(self):
+        """Make this the trace counted by count() on this thread until it is finished."""
+        local.trace = self
+
+    def finish(self):
+        local.trace = None
+        self.duration = time.perf_counter() - self.start
+        if self.profile is not None:
+            self.profile.disable()
+
+    def to_record(self, profile_path=None):
+        record = {
+            'id': self.id,
+            'time': self.time,
+            'pid': os.getpid(),
+            'path': self.path,
+            'route': self.route,
+            'event': self.event,
+            'status': self.status,
+            'duration_ms': self.duration * 1000,
+            'stages': {name: seconds * 1000 for name, seconds in self.stages.items()},
+            'counts': dict(self.counts),
+        }
+        if profile_path:
+            record['profile'] = profile_path
+        return record
+
+
+class WebhookHubTracer:
+    """
+    Traces a sample of requests, writing each trace as a line of JSON to a file from a background thread.
+
+    With profile_slowest, sampled requests are also profiled with cProfile, and the profiles of the slowest of them
+    (of those handled by this process so far) are kept in profile_dir as <trace id>.prof, readable with pstats.
+    The writer thread is started on first use in each process, and every process appends whole lines to the same file.
+    """
+
+    def __init__(self, path, sample_rate=1.0, profile_slowest=0, profile_dir=None, max_pending=DEFAULT_MAX_PENDING):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.profile_slowest = profile_slowest
+        self.profile_dir = profile_dir or os.path.dirname(os.path.abspath(path))
+        self.max_pending = max_pending
+
+        self.queue = None
+        self.writer = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+        # Durations and paths of the profiles kept, as a heap whose smallest (fastest) profile is replaced first
+        self.profiles = []
+
+    def __str__(self):
+        return 'WebhookHubTracer({0}, sample_rate={1}, profile_slowest={2})'.format(self.path, self.sample_rate, self.profile_slowest)
+
+    def start(self):
+        """Start the writer thread of this tracer, unless it is already running in this process."""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.max_pending)
+            self.profiles = []
+            self.writer = threading.Thread(target=self.write, name='webhookhub-tracer', daemon=True)
+            self.writer.start()
+
+    def start_trace(self, path):
+        """Start tracing a request, returning its trace, or None if it isn't sampled."""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        self.start()
+
+        trace = WebhookHubTrace(path)
+        if self.profile_slowest:
+            trace.profile = cProfile.Profile()
+            try:
+                trace.profile.enable()
+            except ValueError:
+                # Another profiler is already active (from Python 3.12, only one can be at a time)
+                trace.profile = None
+        trace.activate()
+        return trace
+
+    def finish_trace(self, trace):
+        """Finish tracing a request, leaving its trace (and profile, if it is one of the slowest) to be written."""
+        trace.finish()
+
+        profile_path = None
+        if trace.profile is not None:
+            profile_path = self.keep_profile(trace)
+            if profile_path:
+                self.submit(('profile', trace.profile, profile_path))
+
+        self.submit(('trace', trace.to_record(profile_path=profile_path), None))
+
+    def keep_profile(self, trace):
+        """Get the path to keep the profile of a trace in, if it is one of the slowest, removing the profile it replaces."""
+        path = os.path.join(self.profile_dir, trace.id + PROFILE_SUFFIX)
+        with self.lock:
+            if len(self.profiles) < self.profile_slowest:
+                heapq.heappush(self.profiles, (trace.duration, path))
+                return path
+            if trace.duration <= self.profiles[0][0]:
+                return None
+            _, replaced_path = heapq.heapreplace(self.profiles, (trace.duration, path))
+        self.submit(('remove', None, replaced_path))
+        return path
+
+    def submit(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def write(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        while True:
+            items = [self.queue.get()]
+            # Write every trace waiting at once, as whole lines in a single write so processes never interleave them
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for kind, value, path in items:
+                try:
+                    if kind == 'trace':
+                        lines.append(json.dumps(value) + '\n')
+                    elif kind == 'profile':
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        value.dump_stats(path)
+                    elif kind == 'remove':
+                        os.remove(path)
+                except (OSError, TypeError, ValueError) as e:
+                    sys.stderr.write('Failed to write trace: {0}\n'.format(e))
+
+            if self.dropped:
+                with self.lock:
+                    dropped, self.dropped = self.dropped, 0
+                sys.stderr.write('Dropped {0} traces waiting to be written\n'.format(dropped))
+
+            try:
+                if lines:
+                    os.write(fd, ''.join(lines).encode('utf-8'))
+            except OSError as e:
+                sys.stderr.write('Failed to write traces to {0}: {1}\n'.format(self.path, e))
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def join(self, timeout=None):
+        """Wait for every finished trace to be written, or until the timeout (in seconds) passes."""
+        if self.queue is None or self.pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                sys.stderr.write('Gave up waiting for {0} traces to be written\n'.format(self.queue.unfinished_tasks))
+                break
+            time.sleep(0.05)
@@ -0,0 +1,173 @@
+# Copyright (c) 2018 Brethren Studios
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import signal
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+
+
+__author__ = 'Evan Williams'
+
+
+SERVER_MODES = ('thread', 'process')
+
+# Number of workers used by each mode when none is specified
+DEFAULT_THREAD_WORKERS = 16
+DEFAULT_PROCESS_WORKERS = os.cpu_count() or 1
+
+# Pending connections the listening socket will queue (HTTPServer defaults to 5, which overflows during bursts)
+REQUEST_QUEUE_SIZE = 128
+
+
+class WebhookHubServer(HTTPServer):
+    """The single-threaded server, handling one request at a time."""
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+class WebhookHubThreadPoolServer(WebhookHubServer):
+    """Handles requests concurrently using a bounded pool of worker threads."""
+
+    def __init__(self, server_address, request_handler_class, workers):
+        super().__init__(server_address, request_handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='webhookhub-worker')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+def make_server(port, request_handler_class, mode=None, workers=None):
+    """Create a server for the given mode, which is single-threaded if no mode is specified."""
+    server_address = ('', port)
+
+    if mode == 'thread':
+        return WebhookHubThreadPoolServer(server_address, request_handler_class, workers or DEFAULT_THREAD_WORKERS)
+    elif mode == 'process' or mode is None:
+        return WebhookHubServer(server_address, request_handler_class)
+    else:
+        raise ValueError('unknown server mode "{0}"'.format(mode))
+
+
+def start_server(port, request_handler_class, mode=None, workers=None, initializer=None, finalizer=None):
+    """
+    Serve webhook events until interrupted.
+    The initializer and finalizer are called before and after serving, in every worker process when forking.
+    """
+    server = make_server(port, request_handler_class, mode=mode, workers=workers)
+
+    if mode == 'process':
+        try:
+            serve_preforked(server, workers or DEFAULT_PROCESS_WORKERS, initializer=initializer, finalizer=finalizer)
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        return
+
+    if initializer:
+        initializer()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.server_close()
+
+    if finalizer:
+        finalizer()
+
+
+def serve_preforked(server, workers, initializer=None, finalizer=None):
+    """
+    Fork worker processes which all accept connections from the listening socket of the given server,
+    replacing any worker that exits until this (parent) process is interrupted or terminated.
+    """
+    # Workers race to accept each connection, so the losers must not block in accept()
+    server.socket.setblocking(False)
+
+    children = set()
+
+    def fork_worker():
+        pid = os.fork()
+        if pid == 0:
+            # Workers are stopped by the parent process, which is sent SIGINT (e.g. Ctrl-C) along with them
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, terminate)
+            signal.signal(signal.SIGHUP, worker_sighup_handler)
+            try:
+                if initializer:
+                    initializer()
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                try:
+                    if finalizer:
+                        finalizer()
+                finally:
+                    os._exit(0)
+        children.add(pid)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    def forward(signum, frame):
+        for pid in children:
+            os.kill(pid, signum)
+
+    # Workers keep their own SIGHUP handling (e.g. reloading configuration), while the parent forwards it to them
+    worker_sighup_handler = signal.getsignal(signal.SIGHUP)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, forward)
+
+    try:
+        for _ in range(workers):
+            fork_worker()
+
+        while True:
+            pid, status = os.wait()
+            children.discard(pid)
+            sys.stderr.write('Worker process {0} exited with status {1}, restarting it\n'.format(pid, status))
+            fork_worker()
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
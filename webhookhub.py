@@ -25,14 +25,24 @@
 import argparse
 import json
 import os
+import signal
 import sys
+import time
 
-from http.server import HTTPServer
-
-from src.route import WebhookHubRoute
+from src.batch import DEFAULT_CHUNK_SIZE, render_batch
+from src.bench import WebhookHubBenchmark, WebhookHubStubDestination, format_results, load_corpus
+from src.cache import WebhookHubCache
+from src.capture import WebhookHubCaptureLog, DEFAULT_CAPTURE_FILE_SIZE, DEFAULT_CAPTURE_FILES, read_capture
+from src.delivery import WebhookHubDeliveryClient, WebhookHubDeliveryQueue, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_DELIVERY_WORKERS, DEFAULT_FANOUT_WORKERS, DEFAULT_QUEUE_SIZE, DEFAULT_MAX_ATTEMPTS
+from src.journal import WebhookHubJournal
+from src.payload import DEFAULT_MAX_PAYLOAD_SIZE, JSON_BACKEND
+from src.ratelimit import WebhookHubRateLimiter
+from src.replay import WebhookHubReplayer, DEFAULT_REPLAY_CONCURRENCY, DEFAULT_REPLAY_TIMEOUT
 from src.parser import WebhookHubParser
 from src.server import make_WebhookHubRequestHandler_class
 from src.shell import start_shell
+from src.tracing import WebhookHubTracer
+from src.workers import start_server, SERVER_MODES
 
 
 __author__ = 'Evan Williams'
@@ -45,6 +55,7 @@ __email__ = "evanw555@gmail.com"
 ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
 CONFIG_DIR = os.path.join(ROOT_DIR, 'config')
 TEMPLATES_DIR = os.path.join(ROOT_DIR, 'templates')
+CORPUS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'corpus')
 
 
 if __name__ == '__main__':
@@ -55,32 +66,117 @@ if __name__ == '__main__':
     start_parser = subparsers.add_parser('start', description='Start WebhookHub server.', help='start server instance')
     start_parser.add_argument('-p', dest='port', required=True, help='port to run the server on')
     start_parser.add_argument('--debug', dest='debug', action='store_true', help='run with extra debug logging')
+    start_parser.add_argument('--mode', dest='mode', choices=SERVER_MODES, default=None, help='handle requests concurrently using a pool of threads, or pre-forked processes sharing one socket')
+    start_parser.add_argument('--project-payloads', dest='project_payloads', action='store_true', help='only keep the parts of payloads their route refers to while handling them, holding less memory for large payloads at the cost of walking them once more')
+    start_parser.add_argument('--max-payload-size', dest='max_payload_size', type=int, default=DEFAULT_MAX_PAYLOAD_SIZE, help='maximum size in bytes of webhook event payloads, larger ones being refused with 413')
+    start_parser.add_argument('--pool-size', dest='pool_size', type=int, default=DEFAULT_POOL_SIZE, help='number of keep-alive connections to keep open to each destination host')
+    start_parser.add_argument('--connect-timeout', dest='connect_timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT, help='seconds to wait for a connection to a destination')
+    start_parser.add_argument('--read-timeout', dest='read_timeout', type=float, default=DEFAULT_READ_TIMEOUT, help='seconds to wait for a response from a destination')
+    start_parser.add_argument('--delivery-workers', dest='delivery_workers', type=int, default=DEFAULT_DELIVERY_WORKERS, help='number of threads delivering webhook events for routes with async-delivery')
+    start_parser.add_argument('--fanout-workers', dest='fanout_workers', type=int, default=DEFAULT_FANOUT_WORKERS, help='number of threads delivering webhook events to their targets at once, for events with several targets')
+    start_parser.add_argument('--queue-size', dest='queue_size', type=int, default=DEFAULT_QUEUE_SIZE, help='number of webhook events which may wait for delivery before new ones are refused')
+    start_parser.add_argument('--max-attempts', dest='max_attempts', type=int, default=DEFAULT_MAX_ATTEMPTS, help='number of times to attempt delivering a queued webhook event before dropping it')
+    start_parser.add_argument('--journal', dest='journal_dir', default=None, help='directory of a journal in which queued webhook events are kept until delivered, surviving restarts')
+    start_parser.add_argument('--rate-limit', dest='rate_limit', type=float, default=None, help='webhook events per second to send each destination until it reports its own rate limits')
+    start_parser.add_argument('--coalesce', dest='coalesce', type=int, default=1, help='maximum number of queued webhook events to merge into one message for a rate limited destination')
+    start_parser.add_argument('--reload-interval', dest='reload_interval', type=float, default=None, help='seconds between checks for changed configuration and template files (they are always reloaded on SIGHUP)')
+    start_parser.add_argument('--trace', dest='trace_filepath', default=None, help='filepath of a file to append traces of requests to, as lines of JSON timing each stage of handling them')
+    start_parser.add_argument('--trace-sample-rate', dest='trace_sample_rate', type=float, default=1.0, help='fraction of requests to trace, between 0 and 1')
+    start_parser.add_argument('--profile-slowest', dest='profile_slowest', type=int, default=0, help='number of the slowest traced requests to keep cProfile profiles of (every traced request is profiled)')
+    start_parser.add_argument('--profile-dir', dest='profile_dir', default=None, help='directory to keep profiles in, by default that of the trace file')
+    start_parser.add_argument('--capture', dest='capture_dir', default=None, help='directory to record every inbound request in (its headers, raw body and timing), for replaying later')
+    start_parser.add_argument('--capture-file-size', dest='capture_file_size', type=int, default=DEFAULT_CAPTURE_FILE_SIZE, help='uncompressed bytes written to a capture file before starting the next one')
+    start_parser.add_argument('--capture-files', dest='capture_files', type=int, default=DEFAULT_CAPTURE_FILES, help='number of capture files to keep per worker process, removing the oldest')
+    start_parser.add_argument('--workers', dest='workers', type=int, default=None, help='number of worker threads or processes to handle requests with')
 
     parse_parser = subparsers.add_parser('parse', description='Parse text in an interactive shell using WebhookHub template syntax.', help='parse text in an interactive shell')
     parse_group = parse_parser.add_mutually_exclusive_group()
     parse_group.add_argument('-p', dest='payload_filepath', default=None, help='filepath of payload to use when evaluating variables')
     parse_group.add_argument('-r', dest='payload_raw', default=None, help='raw string payload to use when evaluating variables')
  
+
+    bench_parser = subparsers.add_parser('bench', description='Benchmark WebhookHub by replaying recorded webhook events through the configured routes and templates to a local stub destination.', help='benchmark the configured routes and templates')
+    bench_parser.add_argument('-n', dest='iterations', type=int, default=200, help='number of times to replay each recorded webhook event')
+    bench_parser.add_argument('--corpus', dest='corpus_dir', default=CORPUS_DIR, help='directory of recorded webhook events (.json files holding their headers and payload)')
+    bench_parser.add_argument('--warmup', dest='warmup', type=int, default=1, help='number of unmeasured rounds to replay first')
+    bench_parser.add_argument('--project', dest='project_payloads', action='store_true', help='project payloads onto the parts their route refers to, as with start --project-payloads')
+    bench_parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON, to compare between versions')
+    bench_parser.add_argument('-o', dest='output_filepath', default=None, help='filepath to also write the results to as JSON')
+
+    render_parser = subparsers.add_parser('render', description='Render archived webhook events, one JSON record of their headers and payload per line, with the configured routes and templates.', help='render archived webhook events')
+    render_parser.add_argument('-i', dest='input_filepath', default='-', help='filepath of the archived webhook events (JSON lines of "headers", "payload" and optionally "path"), or - for stdin')
+    render_parser.add_argument('-o', dest='output_filepath', default='-', help='filepath to write the results to (a JSON line per event, in the same order), or - for stdout')
+    render_parser.add_argument('--workers', dest='workers', type=int, default=None, help='number of worker processes to render with, by default one per CPU')
+    render_parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=DEFAULT_CHUNK_SIZE, help='number of webhook events sent to a worker process at once')
+    render_parser.add_argument('--deliver', dest='deliver', action='store_true', help='also deliver each rendered webhook event to its destination, e.g. to backfill a new destination')
+
+    replay_parser = subparsers.add_parser('replay', description='Re-send requests recorded with --capture to a WebhookHub server.', help='replay captured requests')
+    replay_parser.add_argument('captures', nargs='+', help='capture files, or directories of them')
+    replay_parser.add_argument('-u', dest='url', required=True, help='base URL of the server to send requests to, e.g. http://localhost:8000')
+    replay_parser.add_argument('--speed', dest='speed', default='1', help='multiple of the original rate to send requests at, or "max" to send them as fast as possible')
+    replay_parser.add_argument('--concurrency', dest='concurrency', type=int, default=DEFAULT_REPLAY_CONCURRENCY, help='maximum number of requests in flight at once')
+    replay_parser.add_argument('--timeout', dest='timeout', type=float, default=DEFAULT_REPLAY_TIMEOUT, help='seconds to wait for each response')
+
     args = arg_parser.parse_args()
 
     if args.command == 'start':
-        config_files = [os.path.join(CONFIG_DIR, file) for file in os.listdir(CONFIG_DIR) if file.endswith('.ini')]
-
-        routes = {route.agent: route for route in [WebhookHubRoute.from_file(file) for file in config_files]}
+        cache = WebhookHubCache(CONFIG_DIR, TEMPLATES_DIR)
 
         if args.debug:
-            for route in routes.values():
+            for route in cache.snapshot.routes.values():
                 print(route)
 
-        request_handler_class = make_WebhookHubRequestHandler_class(routes, TEMPLATES_DIR, debug=args.debug)
-        server = HTTPServer(('', int(args.port)), request_handler_class)
+        def reload_configuration(signum, frame):
+            cache.refresh(force=True)
+            sys.stderr.write('Reloaded configuration, now serving {0}\n'.format(cache))
 
-        try:
-            server.serve_forever()
-        except KeyboardInterrupt:
-            pass
+        signal.signal(signal.SIGHUP, reload_configuration)
+
+        delivery_client = WebhookHubDeliveryClient(pool_size=args.pool_size, connect_timeout=args.connect_timeout, read_timeout=args.read_timeout)
+        if args.debug:
+            print(delivery_client)
+
+        journal = WebhookHubJournal(args.journal_dir) if args.journal_dir else None
+        rate_limiter = WebhookHubRateLimiter(rate=args.rate_limit)
+        delivery_queue = WebhookHubDeliveryQueue(delivery_client, workers=args.delivery_workers, max_size=args.queue_size,
+            max_attempts=args.max_attempts, journal=journal, rate_limiter=rate_limiter, max_coalesce=args.coalesce, debug=args.debug)
+        if args.debug:
+            print(delivery_queue)
+
+        tracer = None
+        if args.trace_filepath:
+            tracer = WebhookHubTracer(args.trace_filepath, sample_rate=args.trace_sample_rate, profile_slowest=args.profile_slowest, profile_dir=args.profile_dir)
+            if args.debug:
+                print(tracer)
+
+        capture_log = None
+        if args.capture_dir:
+            capture_log = WebhookHubCaptureLog(args.capture_dir, max_file_size=args.capture_file_size, max_files=args.capture_files)
+            if args.debug:
+                print(capture_log)
+
+        request_handler_class = make_WebhookHubRequestHandler_class(cache, delivery_client=delivery_client, delivery_queue=delivery_queue,
+            rate_limiter=rate_limiter, fanout_workers=args.fanout_workers, max_payload_size=args.max_payload_size, tracer=tracer,
+            capture_log=capture_log, project_payloads=args.project_payloads, debug=args.debug)
+        if args.debug:
+            print('decoding payloads with {0}'.format(JSON_BACKEND))
 
-        server.server_close()
+        def initialize_worker():
+            # Start delivering (and replaying journaled) webhook events right away, and watch for configuration changes
+            delivery_queue.start()
+            if args.reload_interval:
+                cache.watch(args.reload_interval)
+
+        def finalize_worker():
+            # Give queued webhook events a chance to be delivered, and traces to be written, before exiting
+            delivery_queue.join(timeout=args.read_timeout)
+            if tracer:
+                tracer.join(timeout=args.read_timeout)
+            if capture_log:
+                capture_log.close(timeout=args.read_timeout)
+
+        start_server(int(args.port), request_handler_class, mode=args.mode, workers=args.workers,
+            initializer=initialize_worker, finalizer=finalize_worker)
 
     elif args.command == 'parse':
         try:
@@ -100,6 +196,63 @@ if __name__ == '__main__':
 
         start_shell('WebhookHub {0} parser shell - {1}'.format(__version__, __copyright__), payload)
 
+    elif args.command == 'bench':
+        try:
+            samples = load_corpus(args.corpus_dir)
+        except FileNotFoundError as e:
+            sys.stderr.write('No such file or directory: \'{0}\'\n'.format(e.filename))
+            sys.exit(1)
+        if not samples:
+            sys.stderr.write('No recorded webhook events in {0}\n'.format(args.corpus_dir))
+            sys.exit(1)
+
+        stub_destination = WebhookHubStubDestination()
+        stub_destination.start()
+        # Routes whose destination comes from the environment evaluate it as usual, though every event goes to the stub
+        os.environ['WEBHOOK_DESTINATION_URL'] = stub_destination.url
+
+        delivery_client = WebhookHubDeliveryClient()
+        benchmark = WebhookHubBenchmark(WebhookHubCache(CONFIG_DIR, TEMPLATES_DIR), delivery_client, stub_destination.url, project_payloads=args.project_payloads)
+        benchmark.run(samples, args.iterations, warmup=args.warmup)
+        delivery_client.close()
+        stub_destination.stop()
+
+        results = dict(benchmark.results(), version=__version__, samples=[sample.name for sample in samples], iterations=args.iterations)
+        print(json.dumps(results, indent=2, sort_keys=True) if args.json else format_results(results))
+        if args.output_filepath:
+            with open(args.output_filepath, 'w') as fout:
+                json.dump(results, fout, indent=2, sort_keys=True)
+
+    elif args.command == 'render':
+        try:
+            fin = sys.stdin.buffer if args.input_filepath == '-' else open(args.input_filepath, 'rb')
+            fout = sys.stdout if args.output_filepath == '-' else open(args.output_filepath, 'w')
+        except FileNotFoundError as e:
+            sys.stderr.write('No such file or directory: \'{0}\'\n'.format(e.filename))
+            sys.exit(1)
+
+        start = time.monotonic()
+        with fin, fout:
+            records, failed = render_batch(fin, fout, CONFIG_DIR, TEMPLATES_DIR, workers=args.workers, chunk_size=args.chunk_size, deliver=args.deliver)
+        sys.stderr.write('Rendered {0} webhook events ({1} failed) in {2:.2f} seconds\n'.format(records, failed, time.monotonic() - start))
+
+    elif args.command == 'replay':
+        try:
+            speed = None if args.speed == 'max' else float(args.speed)
+            if speed is not None and speed <= 0:
+                raise ValueError()
+        except ValueError:
+            sys.stderr.write('Speed must be a number or "max"\n')
+            sys.exit(1)
+
+        replayer = WebhookHubReplayer(args.url, speed=speed, concurrency=args.concurrency, timeout=args.timeout)
+        try:
+            elapsed = replayer.replay(read_capture(args.captures))
+        except FileNotFoundError as e:
+            sys.stderr.write('No such file or directory: \'{0}\'\n'.format(e.filename))
+            sys.exit(1)
+        print(replayer.summary(elapsed))
+
     else:
         arg_parser.print_help()
 